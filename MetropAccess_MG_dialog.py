@@ -9,6 +9,7 @@
 #---------------------------------------------
 
 import os, wx
+from multiprocessing import cpu_count
 
 #Inspired from: http://wiki.wxpython.org/AnotherTutorial, http://www.blog.pythonlibrary.org/2010/05/15/manipulating-pdfs-with-python-and-pypdf/
 class MyFileDropTarget(wx.FileDropTarget):
@@ -117,6 +118,13 @@ class DialogPanel(wx.Panel):
         wx.StaticText(self, -1, 'N. classes', (397, 266))
         self.Nclasses = wx.SpinCtrl(self, -1, '10', (70, 80), (60, -1), min=2, max=30)
 
+        #Ask the number of worker processes that will be used for rendering the maps
+        wx.StaticText(self, -1, 'N. workers', (397, 235))
+        self.Nworkers = wx.SpinCtrl(self, -1, '1', (70, 80), (60, -1), min=1, max=cpu_count())
+
+        #Ask if only the travel time statistics are computed (no maps are drawn)
+        self.statisticsOnly = wx.CheckBox(self, label="Statistics only")
+
         GenerateBtn = wx.Button(self, label="           Run MapGenerator        ")
         GenerateBtn.Bind(wx.EVT_BUTTON, self.CheckPaths)        #This runs method that checks  valid paths and returns them to the MetropAccess_MapGenerator_main
 
@@ -128,7 +136,7 @@ class DialogPanel(wx.Panel):
                    (RoadLbl, self.roadPath, roadBtn),
                    (metroLbl, self.metroPath, metroBtn),
                    (outputLbl, self.outputPath, outputBtn),
-                   (attributeLbl, attributeCB),
+                   (attributeLbl, attributeCB, self.Nworkers),
                     (classifLbl, classificationCB, self.Nclasses)]
 
  
@@ -137,8 +145,11 @@ class DialogPanel(wx.Panel):
         for widget in widgets:
             self.buildRows(widget)
 
-        #Set placement for 'Run MapGenerator' button separately
-        self.mainSizer.Add(GenerateBtn, 1, wx.ALL|wx.CENTER, 5)
+        #Set placement for 'Run MapGenerator' button and 'Statistics only' checkbox separately
+        runSizer = wx.BoxSizer(wx.HORIZONTAL)
+        runSizer.Add(self.statisticsOnly, 0, wx.ALL|wx.CENTER, 5)
+        runSizer.Add(GenerateBtn, 0, wx.ALL|wx.CENTER, 5)
+        self.mainSizer.Add(runSizer, 1, wx.ALL|wx.CENTER, 5)
         self.SetSizer(self.mainSizer)
  
     #----------------------------------------------------------------------
@@ -290,6 +301,8 @@ class DialogPanel(wx.Panel):
         attribute = self.attributeParameter
         classification = self.classifMethod
         NumberOfClasses = self.Nclasses.GetValue()
+        NumberOfWorkers = self.Nworkers.GetValue()
+        StatisticsOnly = self.statisticsOnly.GetValue()
         
         if not os.path.isdir(inputs):
             msg = "The input folder %s does not exist!" % inputs
@@ -356,7 +369,7 @@ class DialogPanel(wx.Panel):
             return
 
 
-        Paths = inputs,Ykr,Ykr_pop,Coasts,Roads,Metro, outputF, attribute, classification, NumberOfClasses
+        Paths = inputs,Ykr,Ykr_pop,Coasts,Roads,Metro, outputF, attribute, classification, NumberOfClasses, NumberOfWorkers, StatisticsOnly
         self.app.SetValue(Paths)
          
         #Reset dialog values
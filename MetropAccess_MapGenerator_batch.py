@@ -0,0 +1,565 @@
+# -*- coding: cp1252 -*-
+
+#---------------------------------------------
+# METROPACCESS-MAPGENERATOR
+# Accessibility Research Group
+# University of Helsinki
+# Authored by Henrikki Tenkanen
+# Licenced with GNU General Public License v3.
+#---------------------------------------------
+
+#Headless batch runs of MapGenerator (no wx): parameters are given as command line arguments or in a JSON config file,
+#maps are drawn with the Agg backend and the progress is printed to stdout. The GUI (MetropAccess_MapGenerator_main)
+#runs the same MapRun in a thread.
+#
+#Usage: python MetropAccess_MapGenerator_batch.py --config run.json [options]  (see --help)
+
+import os, sys, time, json, argparse, subprocess
+from multiprocessing import Pool
+import matplotlib
+
+#Maps are only saved to files --> both the batch command and the GUI (MetropAccess_MapGenerator_main imports this module first)
+#draw with Agg, which works also on render servers without a display. Agg has to be chosen before pyplot is imported.
+if not 'matplotlib.pyplot' in sys.modules:
+    matplotlib.use('Agg')
+
+import MetropAccess_MapGenerator_classes as MGC
+import MetropAccess_MapGenerator_store as MGS
+
+class MapRun:
+    """Generates the maps (or only the statistics) of the files with the parameters of the dialog
+    (inputs, Ykr, Ykr_pop, coast, roads, metro, output folder, travel mode, classification, N. classes, N. workers, statistics only).
+    Progress is reported with notify, which prints the throughput to stdout (the GUI shows a progress dialog instead)."""
+    def __init__(self, tuple, files, options=None):
+        """Constructor, options are the settings that are not asked in the dialog (see main for the command line options)"""
+        self.inputF = tuple[0]
+        self.Ykr = tuple[1]
+        self.Ykr_pop = tuple[2]
+        self.Coast = tuple[3]
+        self.Roads = tuple[4]
+        self.Metro = tuple[5]
+        self.outputF = tuple[6]
+        self.travelMode = tuple[7]
+        self.classifMethod = tuple[8]
+        self.Nclasses = tuple[9]
+
+        #Number of worker processes used for rendering (1 --> maps are rendered in this thread)
+        if len(tuple) > 10:
+            self.Nworkers = tuple[10]
+        else:
+            self.Nworkers = 1
+
+        #Compute only the travel time statistics (no maps)
+        if len(tuple) > 11:
+            self.statisticsOnly = tuple[11]
+        else:
+            self.statisticsOnly = False
+
+        #Optional settings that are not asked in the dialog
+        if options == None:
+            options = {}
+
+        #Attribute/classification pairs mapped from each file (default: travel mode and classification of the dialog)
+        self.mapList = options.get('mapList', [(self.travelMode, self.classifMethod)])
+        self.attributes = [pair[0] for pair in self.mapList]
+        self.modeText = ", ".join(self.attributes)
+
+        #Keyword arguments for MapGenerator
+        self.MGoptions = {'renderer': options.get('renderer', 'template'),
+                          'staticBackground': options.get('staticBackground', False),
+                          'matrixStore': options.get('matrixStore', None),
+                          'dpi': options.get('dpi', 300),
+                          'imageFormat': options.get('imageFormat', 'png'),
+                          'compression': options.get('compression', 6),
+                          'quality': options.get('quality', 90),
+                          'writerThreads': options.get('writerThreads', 2),
+                          'mapList': self.mapList,
+                          'renderCache': options.get('renderCache', True),
+                          'binaryStatistics': options.get('binaryStatistics', False),
+                          'shard': options.get('shard', None),
+                          'timeStages': options.get('report', False),
+                          'memoryLimit': options.get('memoryLimit', None),
+                          'classifier': options.get('classifier', 'fast'),
+                          'classifierSample': options.get('classifierSample', None),
+                          'classBreaks': options.get('classBreaks', None)}
+
+        #Number of matrices read and prepared ahead while the current map is drawn (0 --> files are processed one at a time)
+        self.prefetch = options.get('prefetch', 2)
+
+        #Record completed files to a run journal in the output folder, a restarted run continues from the remaining files
+        self.useJournal = options.get('journal', True)
+        self.journal = None
+
+        #Worker processes are replaced with new ones after this many files (None --> workers live until the end of the run)
+        self.recycleWorkers = options.get('recycleWorkers', None)
+
+        #Time the stages of each map and write them to a run report (see MGC.RunReport)
+        self.report = None
+
+        #Folder for cached projected geometries (None --> shapefiles are read every time)
+        self.cacheFolder = options.get('cacheFolder', MGC.defaultCacheFolder())
+
+        #Data driven classifications use the same class breaks in all maps (calculated from all files or a sample of sharedSample files
+        #before the maps are drawn, see MGC.sharedBreaks). Breaks come from all the files, so that all shards use the same breaks.
+        self.sharedBreaks = options.get('sharedBreaks', False)
+        self.sharedSample = options.get('sharedSample', None)
+        self.allFiles = files
+
+        #Run only one shard (i, n) of the files, e.g. on several machines (see MGC.mergeStatistics for combining the statistics)
+        self.shard = self.MGoptions['shard']
+        self.files = MGC.shardFiles(files, self.shard, options.get('shardMethod', 'hash'))
+        if self.shard != None:
+            print "Shard %d/%d: %d of %d files" % (self.shard[0], self.shard[1], len(self.files), len(files))
+
+        self.running = True
+
+        #Throughput reporting (files skipped because of the journal are not counted)
+        self.startTime = time.time()
+        self.lastReport = self.startTime
+        self.processed = 0
+        self.skipped = 0
+
+
+    def notify(self, event, msg):
+        """Progress of the run: 'info' (file name, travel modes, processed files), 'update' (one file is done) and 'exit' (output folder)"""
+        if event == "update":
+            self.processed += 1
+            if time.time()-self.lastReport >= 10 or self.processed == len(self.files):
+                self.lastReport = time.time()
+                print "%d/%d files, %s" % (self.processed, len(self.files), self.throughput())
+        elif event == "exit":
+            print "Finished %d files in %0.0f s (%s), results in %s" % (self.processed-self.skipped, time.time()-self.startTime, self.throughput(), msg)
+
+    def throughput(self):
+        #Files (and maps) per second since the start of the run
+        rate = (self.processed-self.skipped) / max(time.time()-self.startTime, 1e-6)
+        if self.statisticsOnly:
+            return "%0.1f files/s" % rate
+        return "%0.1f files/s, %0.1f maps/s" % (rate, rate*len(self.mapList))
+
+    def run(self):
+        while self.running:
+            if self.statisticsOnly:
+                self.genStatistics()
+                continue
+
+            if self.sharedBreaks and self.MGoptions['classBreaks'] == None:
+                self.calculateBreaks()
+
+            if self.useJournal:
+                self.openJournal()
+
+            if self.MGoptions['timeStages']:
+                self.openReport()
+
+            if self.Nworkers > 1:
+                #Worker processes create their own map instances
+                self.genMapsParallel()
+            else:
+                self.mapInstance()
+                self.genMaps()
+
+    def mapInstance(self):
+
+        #Create matplotlib basemap instance and pandas dataframes that contains the geometries
+        Geometries = MGC.MapInstance(self.Ykr, self.Coast, self.Roads, self.Metro, self.cacheFolder)
+
+        #Get geometries as matplotlib basemap instance (B) and pandas dataframes (Y,C,R,M)
+        B = Geometries.getBasemap()
+        Y = Geometries.getYkr()
+        C = Geometries.getCoast()
+        R = Geometries.getRoads()
+        M = Geometries.getMetro()
+        coords = Geometries.getCoords()
+        gridIndex = Geometries.getGridIndex()
+
+        #Create MapGenerator instance (with a journal the statistics rows are collected and written to the journal)
+        self.MG = MGC.MapGenerator(B, Y, self.Ykr_pop, C, R, M, self.outputF, self.travelMode, self.classifMethod, coords, self.Nclasses,
+                                   collectStatistics=self.journal != None, gridIndex=gridIndex, **self.MGoptions)
+
+        del Geometries, B, Y, C, R, M, coords, gridIndex
+        #------------------------------------------------
+    def calculateBreaks(self):
+        #Shared class breaks are part of the MapGenerator options (--> workers, journal settings and render cache keys get them)
+        start = time.time()
+        gridIndex = MGC.loadGridIndex(self.Ykr, self.Coast, self.Roads, self.Metro, self.cacheFolder)
+        breaks = MGC.sharedBreaks(self.allFiles, gridIndex, self.mapList, self.Nclasses, self.MGoptions['matrixStore'], self.sharedSample)
+        for (attribute, classification), bins in sorted(breaks.items()):
+            print "Shared class breaks of %s (%s): %s" % (attribute, classification, ", ".join("%0.0f" % b for b in bins))
+        print "Shared class breaks calculated in %0.1f s" % (time.time()-start)
+        self.MGoptions['classBreaks'] = breaks
+
+    def openJournal(self):
+        #Settings that change the maps start a new journal (writer threads do not change them), and so do changed inputs:
+        #the matrices (files of the shard or the matrix store), the population file and the shapefiles
+        settings = dict((k, v) for k, v in self.MGoptions.items() if not k in ['writerThreads', 'shard', 'timeStages', 'memoryLimit'])
+        inputs = (os.path.abspath(self.inputF), MGC.inputSignature(self.files, self.MGoptions['matrixStore']), MGC.fileSignature(self.Ykr_pop),
+                  [MGC.fileSignature(f) for f in [self.Ykr, self.Coast, self.Roads, self.Metro]])
+        self.journal = MGC.RunJournal(self.outputF, self.attributes, repr((self.Nclasses, sorted(settings.items()), inputs)), self.shard)
+
+        #Files completed by an earlier run are skipped
+        files = self.journal.remaining(self.files)
+        if len(files) < len(self.files):
+            print "Resuming run: %d/%d files completed earlier" % (len(self.files)-len(files), len(self.files))
+            self.skipped = len(self.files)-len(files)
+            for x in xrange(self.skipped):
+                self.notify("update", "")
+        self.remaining = files
+
+    def openReport(self):
+        settings = {'renderer': self.MGoptions['renderer'], 'workers': self.Nworkers, 'prefetch': self.prefetch, 'files': len(self.files)}
+        self.report = MGC.RunReport(self.outputF, self.attributes, settings, self.shard)
+
+    def recordReport(self, basename, exception, timings):
+        #Stage times of a processed file (exceptions of worker processes are text)
+        if self.report == None or timings == None:
+            return
+        if isinstance(exception, (Exception, basestring)):
+            self.report.record(basename, 0, timings, str(exception))
+        else:
+            self.report.record(basename, len(self.mapList), timings)
+
+    def closeReport(self):
+        #Summary of the stages to stdout
+        if self.report != None:
+            print "\n".join(self.report.summary())
+            print "Run report: %s" % self.report.path
+            self.report.close()
+            self.report = None
+
+    def closeJournal(self, failed=set()):
+        #Record the last files and write the statistics files from the journal. A run that was not cancelled and
+        #completed all files is marked finished, so that running it again draws the maps again.
+        if self.journal != None:
+            self.journal.commit(failed=failed)
+            self.journal.writeStatistics(self.MGoptions['binaryStatistics'])
+            if self.running and len(self.journal.remaining(self.files)) == 0:
+                self.journal.finish()
+            self.journal.close()
+            self.journal = None
+
+    def genMaps(self):
+        #Iterate over files and create maps
+        files = self.files
+        if self.journal != None:
+            files = self.remaining
+        i = len(self.files)-len(files)+1
+        filecount = str(len(self.files))
+
+        if self.prefetch > 0:
+            #Next matrices are read and classified in background threads while the current map is drawn
+            results = MGC.MapPipeline(self.MG, self.prefetch).run(files)
+        else:
+            results = ((os.path.basename(iFile)[:-4], self.MG.GenerateMap(iFile)) for iFile in files)
+
+        for basename, exception in results:
+
+            #User closed the progress dialog
+            if not self.running:
+                results.close()
+                break
+
+            #Set info texts
+            prosessedFiles = str(i)+'/' + filecount
+            self.notify("info", (basename, self.modeText, prosessedFiles))
+
+            print "Processed file: " + basename
+            print exception
+
+            #Record the file when its maps are on disk
+            if self.journal != None:
+                self.journal.add(basename, self.MG.popStatistics(), not isinstance(exception, Exception))
+                self.journal.commit(*self.MG.unfinishedFiles())
+                self.recordCache()
+
+            if self.report != None:
+                self.recordReport(basename, exception, self.MG.popTimings(basename))
+
+            #Set progress bar
+            self.notify("update", "")
+
+            i+=1
+
+        errors = self.MG.flushImages()
+        self.closeJournal(set(self.MG.outputBasename(error[0]) for error in errors))
+        self.recordCache()
+        self.MG.closeStatistics()
+        self.MG.closeTimings()
+        self.MG.closeWriter()
+        self.closeReport()
+        if self.running:
+            self.notify("exit", self.outputF)
+        self.running = False
+
+    def recordCache(self):
+        #With a journal render cache entries are collected like the statistics rows --> write them to the manifest
+        if self.MG.cache != None and self.MG.cache.collect:
+            self.MG.cache.record(self.MG.cache.popCommitted())
+
+    def genStatistics(self):
+        #Compute the travel time statistics of all files without rendering the maps
+        i = 0
+        filecount = str(len(self.files))
+
+        #Only the YKR_ID index of the grid is needed
+        gridIndex = MGC.loadGridIndex(self.Ykr, self.Coast, self.Roads, self.Metro, self.cacheFolder)
+        SG = MGC.StatisticsGenerator(gridIndex, self.outputF, self.attributes, matrixStore=self.MGoptions['matrixStore'],
+                                     binary=self.MGoptions['binaryStatistics'], shard=self.shard)
+
+        rows = dict((attribute, []) for attribute in self.attributes)
+        for basenames, blockRows in SG.blocks(self.files):
+
+            #User closed the progress dialog
+            if not self.running:
+                return
+
+            for attribute in self.attributes:
+                rows[attribute].extend(blockRows[attribute])
+            i += len(basenames)
+
+            #Set info texts
+            prosessedFiles = str(i)+'/' + filecount
+            self.notify("info", (basenames[-1], self.modeText, prosessedFiles))
+
+            print "Processed files: %s" % prosessedFiles
+
+            #Set progress bar
+            for basename in basenames:
+                self.notify("update", "")
+
+        SG.writeStatistics(rows)
+
+        self.notify("exit", self.outputF)
+        self.running = False
+
+    def workerParameters(self):
+        #Parameters that worker processes need for creating their own MapInstance/MapGenerator
+        return (self.Ykr, self.Ykr_pop, self.Coast, self.Roads, self.Metro, self.outputF, self.travelMode, self.classifMethod, self.Nclasses, self.cacheFolder)
+
+    def genMapsParallel(self):
+        #Spread the files over worker processes, each worker creates MapInstance and MapGenerator only once
+        files = self.files
+        if self.journal != None:
+            files = self.remaining
+        filecount = str(len(self.files))
+
+        #Without a journal statistics rows are written directly to the statistics files
+        statistics = None
+        if self.journal == None:
+            statistics = MGC.StatisticsSink(self.outputF, self.attributes, binary=self.MGoptions['binaryStatistics'], shard=self.shard)
+
+        #Create the geometry cache once here, so that workers only need to load it
+        if self.cacheFolder != None:
+            MGC.MapInstance(self.Ykr, self.Coast, self.Roads, self.Metro, self.cacheFolder)
+
+        #Render cache entries of the workers are written to the manifest here
+        cache = None
+        if self.MGoptions['renderCache']:
+            cache = MGC.RenderCache(self.outputF, shard=self.shard)
+
+        pool = Pool(processes=self.Nworkers, initializer=MGC.initRenderWorker, initargs=(self.workerParameters(), self.MGoptions),
+                    maxtasksperchild=self.recycleWorkers)
+
+        try:
+            #imap returns the results in the same order as the files (--> progress and statistics rows stay in order)
+            i = len(self.files)-len(files)+1
+            for basename, exception, rows, cacheEntries, timings in pool.imap(MGC.renderWorkerFile, files):
+
+                #User closed the progress dialog
+                if not self.running:
+                    break
+
+                #Set info texts
+                prosessedFiles = str(i)+'/' + filecount
+                self.notify("info", (basename, self.modeText, prosessedFiles))
+
+                print "Processed file: " + basename
+                print exception
+
+                #Write statistics of the maps (workers return exceptions as text)
+                if self.journal != None:
+                    self.journal.record(basename, rows, not isinstance(exception, basestring))
+                else:
+                    statistics.writeRows(rows)
+
+                if cache != None:
+                    cache.record(cacheEntries)
+
+                self.recordReport(basename, exception, timings)
+
+                #Set progress bar
+                self.notify("update", "")
+
+                i+=1
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            if statistics != None:
+                statistics.close()
+            self.closeJournal()
+            self.closeReport()
+
+        if self.running:
+            self.notify("exit", self.outputF)
+        self.running = False
+
+
+#Choices of the dialog (see MetropAccess_MG_dialog)
+ATTRIBUTES = ['Walk_time', 'Walk_dist', 'PT_total_time', 'PT_time', 'PT_dist', 'Car_time', 'Car_dist']
+CLASSIFICATIONS = ['5 Minute Equal Intervals', '10 Minute Equal Intervals', '5 Km Equal Intervals', '10 Km Equal Intervals', 'Natural Breaks', 'Quantiles', "Fisher's Jenks"]
+
+#Modules whose import time is reported with --import-times (the last ones are imported only when a run needs them)
+IMPORT_MODULES = ['numpy', 'pandas', 'matplotlib.pyplot', 'MetropAccess_MapGenerator_classes',
+                  'shapely.geometry', 'descartes', 'fiona', 'mpl_toolkits.basemap', 'pysal']
+
+def importTimes(modules=IMPORT_MODULES):
+    """Import time (s) of each module, measured in a new Python process (a module imported already would take no time).
+    Returns (module, seconds) pairs, seconds is None if the module can not be imported."""
+    environment = dict(os.environ, MPLBACKEND='Agg')
+    times = []
+    for module in modules:
+        code = "import time; start = time.time(); import %s; print time.time()-start" % module
+        try:
+            output = subprocess.check_output([sys.executable, "-W", "ignore", "-c", code], stderr=subprocess.STDOUT,
+                                             cwd=os.path.dirname(os.path.abspath(__file__)), env=environment)
+            times.append((module, float(output.strip().split('\n')[-1])))
+        except (subprocess.CalledProcessError, ValueError):
+            times.append((module, None))
+    return times
+
+def parseArguments(argv=None):
+    """Command line arguments. Values of a JSON config file (keys are the option names with '_' instead of '-', e.g. "matrix_store")
+    are used as defaults, so arguments given on the command line override them."""
+    parser = argparse.ArgumentParser(description="Generate MetropAccess accessibility maps without the user interface.")
+    parser.add_argument("--config", help="JSON file with the options of the run")
+    parser.add_argument("--input", help="Folder containing the travel time matrices (time_to_*.txt)")
+    parser.add_argument("--matrix-store", help="Matrix store folder (see MetropAccess_MapGenerator_store), read instead of the text files")
+    parser.add_argument("--output", help="Output folder for the maps and statistics")
+    parser.add_argument("--grid", help="MetropAccess-YKR-grid (.shp)")
+    parser.add_argument("--population", help="Population info (.txt)")
+    parser.add_argument("--coast", help="MetropAccess-Coastline (.shp)")
+    parser.add_argument("--roads", help="MetropAccess-Roads (.shp)")
+    parser.add_argument("--metro", help="MetropAccess-Metro (.shp)")
+    parser.add_argument("--mode", default='PT_total_time', choices=ATTRIBUTES, help="Travel mode (default: %(default)s)")
+    parser.add_argument("--classification", default='10 Minute Equal Intervals', choices=CLASSIFICATIONS, help="Classification method (default: %(default)s)")
+    parser.add_argument("--map", action='append', dest='maps', metavar="MODE:CLASSIFICATION", help="Map drawn from each matrix, can be given several times (replaces --mode and --classification)")
+    parser.add_argument("--classes", type=int, default=10, help="Number of classes (default: %(default)s)")
+    parser.add_argument("--classifier", default='fast', choices=MGC.CLASSIFIERS, help="Engine of Natural Breaks, Quantiles and Fisher's Jenks (default: %(default)s)")
+    parser.add_argument("--classifier-sample", type=int, help="Classify a random sample of this many values of each map ('fast' classifier)")
+    parser.add_argument("--shared-breaks", action='store_true', help="Use the same class breaks in all maps (Natural Breaks, Quantiles, Fisher's Jenks)")
+    parser.add_argument("--shared-sample", type=int, help="Calculate the shared class breaks from a random sample of this many matrices")
+    parser.add_argument("--workers", type=int, default=1, help="Number of rendering processes (default: %(default)s)")
+    parser.add_argument("--statistics-only", action='store_true', help="Compute only the travel time statistics (no maps)")
+    parser.add_argument("--renderer", default='template', choices=['template', 'raster', 'figure'], help="Map renderer (default: %(default)s)")
+    parser.add_argument("--static-background", action='store_true', help="Draw coastline, roads and metro as a cached image")
+    parser.add_argument("--dpi", type=int, default=300, help="Resolution of the maps (default: %(default)s)")
+    parser.add_argument("--format", default='png', choices=sorted(MGC.MGW.FORMATS.keys()), help="Image format (default: %(default)s)")
+    parser.add_argument("--compression", type=int, default=6, help="PNG compression level 0-9 (default: %(default)s)")
+    parser.add_argument("--quality", type=int, default=90, help="JPEG/WebP quality 1-100 (default: %(default)s)")
+    parser.add_argument("--writer-threads", type=int, default=2, help="Threads writing the images (default: %(default)s)")
+    parser.add_argument("--prefetch", type=int, default=2, help="Matrices read ahead while a map is drawn (default: %(default)s)")
+    parser.add_argument("--cache-folder", default=MGC.defaultCacheFolder(), help="Folder for cached geometries (default: %(default)s)")
+    parser.add_argument("--no-journal", action='store_true', help="Do not record the run to a journal (a restarted run starts from the beginning)")
+    parser.add_argument("--no-render-cache", action='store_true', help="Draw all maps again even if they have not changed")
+    parser.add_argument("--binary-statistics", action='store_true', help="Write also a columnar .npz copy of the statistics files")
+    parser.add_argument("--shard", type=MGC.parseShard, help="Process only shard i/n of the destinations (e.g. 2/8)")
+    parser.add_argument("--shard-method", default='hash', choices=['hash', 'range'], help="How destinations are split to shards (default: %(default)s)")
+    parser.add_argument("--merge", action='store_true', help="Merge the statistics fragments of the shards in the output folder and exit")
+    parser.add_argument("--memory-limit", type=float, help="Release matplotlib state when the memory of a process has grown this much (MB) since its first map")
+    parser.add_argument("--recycle-workers", type=int, help="Replace each worker process with a new one after this many files")
+    parser.add_argument("--report", action='store_true', help="Time the stages of each map, write them to RunReport_<modes>.jsonl and print a summary")
+    parser.add_argument("--import-times", action='store_true', help="Print the import times of the heavy modules and exit")
+
+    args, rest = parser.parse_known_args(argv)
+    if args.config != None:
+        with open(args.config) as f:
+            config = json.load(f)
+        unknown = [key for key in config if not hasattr(args, key)]
+        if len(unknown) > 0:
+            parser.error("unknown options in %s: %s" % (args.config, ", ".join(unknown)))
+        parser.set_defaults(**config)
+    args = parser.parse_args(argv)
+
+    if args.maps == None:
+        args.maps = ["%s:%s" % (args.mode, args.classification)]
+    mapList = []
+    for item in args.maps:
+        attribute, sep, classification = item.partition(':')
+        if not attribute in ATTRIBUTES or not classification in CLASSIFICATIONS:
+            parser.error("map '%s' is not MODE:CLASSIFICATION (modes: %s)" % (item, ", ".join(ATTRIBUTES)))
+        mapList.append((attribute, classification))
+    args.mapList = mapList
+
+    if args.import_times:
+        return args
+
+    required = ['output'] if args.merge else ['output', 'grid', 'population', 'coast', 'roads', 'metro']
+    missing = ["--" + name for name in required if getattr(args, name) == None]
+    if args.input == None and args.matrix_store == None and not args.merge:
+        missing.append("--input or --matrix-store")
+    if len(missing) > 0:
+        parser.error("missing %s" % ", ".join(missing))
+    return args
+
+def main(argv=None):
+    args = parseArguments(argv)
+
+    if args.import_times:
+        for module, seconds in importTimes():
+            if seconds == None:
+                print "%-36s not available" % module
+            else:
+                print "%-36s %6.3f s" % (module, seconds)
+        return
+
+    attributes = [attribute for attribute, classification in args.mapList]
+
+    if args.merge:
+        #Combine the statistics fragments written by the shards
+        for attribute in attributes:
+            rows, fragments = MGC.mergeStatistics(args.output, attribute, args.binary_statistics)
+            print "%s: merged %d rows from %d fragments" % (attribute, rows, fragments)
+        return
+
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    if args.input != None:
+        files = MGS.matrixFiles(args.input)
+    else:
+        files = MGS.MatrixStore(args.matrix_store).fileNames()
+    print "%d travel time matrices" % len(files)
+
+    attribute, classification = args.mapList[0]
+    Parameters = (args.input or args.matrix_store, args.grid, args.population, args.coast, args.roads, args.metro, args.output,
+                  attribute, classification, args.classes, args.workers, args.statistics_only)
+    options = {'mapList': args.mapList,
+               'renderer': args.renderer,
+               'staticBackground': args.static_background,
+               'matrixStore': args.matrix_store,
+               'dpi': args.dpi,
+               'imageFormat': args.format,
+               'compression': args.compression,
+               'quality': args.quality,
+               'writerThreads': args.writer_threads,
+               'prefetch': args.prefetch,
+               'cacheFolder': args.cache_folder,
+               'journal': not args.no_journal,
+               'renderCache': not args.no_render_cache,
+               'binaryStatistics': args.binary_statistics,
+               'shard': args.shard,
+               'shardMethod': args.shard_method,
+               'report': args.report,
+               'memoryLimit': args.memory_limit,
+               'recycleWorkers': args.recycle_workers,
+               'classifier': args.classifier,
+               'classifierSample': args.classifier_sample,
+               'sharedBreaks': args.shared_breaks,
+               'sharedSample': args.shared_sample}
+
+    Run = MapRun(Parameters, files, options)
+    Run.run()
+
+if __name__ == '__main__':
+    main()
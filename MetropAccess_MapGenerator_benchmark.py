@@ -0,0 +1,298 @@
+# -*- coding: cp1252 -*-
+
+#---------------------------------------------
+# METROPACCESS-MAPGENERATOR
+# Accessibility Research Group
+# University of Helsinki
+# Authored by Henrikki Tenkanen
+# Licenced with GNU General Public License v3.
+#---------------------------------------------
+
+#Benchmark of MapGenerator with synthetic data: a 250 m grid (default 147 x 90 = 13 230 cells like the YKR grid of the
+#MetropAccess matrices), coastline, roads, metro, population and time_to_*.txt travel time matrices are generated to the
+#work folder. The benchmark times MapInstance construction, latency of a single map (GenerateMap) and the throughput
+#of a whole batch, and compares the maps of the chosen renderer to golden images drawn with the 'figure' renderer.
+#
+#Usage: python MetropAccess_MapGenerator_benchmark.py <work folder> [options]  (see --help)
+
+import os, sys, time, json, argparse
+import numpy as np
+
+#Maps are drawn with Agg (the batch module chooses it before pyplot is imported)
+import MetropAccess_MapGenerator_batch as MGB
+import MetropAccess_MapGenerator_classes as MGC
+import MetropAccess_MapGenerator_store as MGS
+import matplotlib.image as mimage
+
+#South-west corner of the synthetic grid (WGS84) and the size of a degree in meters
+ORIGIN = (24.45, 60.10)
+DEGREE = 111320.0
+
+#Columns of the travel time matrices
+MATRIX_COLUMNS = ['from_id', 'to_id', 'Walk_time', 'Walk_dist', 'PT_total_time', 'PT_time', 'PT_dist', 'Car_time', 'Car_dist']
+
+def toLonLat(x, y):
+    #Meters from the origin to WGS84 coordinates (the area is small enough for a flat approximation)
+    lon = ORIGIN[0] + x / (DEGREE * np.cos(np.radians(ORIGIN[1])))
+    lat = ORIGIN[1] + y / DEGREE
+    return lon, lat
+
+def writeShapefile(path, geometryType, shapes, properties):
+    """Writes shapes (lists of (x, y) in meters) to a WGS84 shapefile. properties is a list of dictionaries (one per shape)."""
+    import fiona
+
+    schema = {'geometry': geometryType, 'properties': dict((key, 'int') for key in properties[0])}
+    with fiona.open(path, 'w', driver='ESRI Shapefile', schema=schema, crs={'init': 'epsg:4326', 'no_defs': True}) as shp:
+        for xy, props in zip(shapes, properties):
+            coords = [toLonLat(x, y) for x, y in xy]
+            if geometryType == 'Polygon':
+                coords = [coords]
+            shp.write({'geometry': {'type': geometryType, 'coordinates': coords}, 'properties': props})
+
+def generateData(folder, columns=147, rows=90, matrices=20, seed=0, cellSize=250):
+    """Writes synthetic input data to folder (grid.shp, coast.shp, roads.shp, metro.shp, population.txt and matrices/time_to_*.txt).
+    The same arguments always give the same data. Returns a dictionary of the paths."""
+    paths = {'grid': os.path.join(folder, "grid.shp"),
+             'coast': os.path.join(folder, "coast.shp"),
+             'roads': os.path.join(folder, "roads.shp"),
+             'metro': os.path.join(folder, "metro.shp"),
+             'population': os.path.join(folder, "population.txt"),
+             'matrices': os.path.join(folder, "matrices")}
+
+    #Data is generated again only if the arguments change
+    settings = {'columns': columns, 'rows': rows, 'matrices': matrices, 'seed': seed, 'cellSize': cellSize}
+    settingsPath = os.path.join(folder, "BenchmarkData.json")
+    if os.path.isfile(settingsPath):
+        with open(settingsPath) as f:
+            if json.load(f) == settings:
+                return paths
+
+    for path in [folder, paths['matrices']]:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    for f in MGS.matrixFiles(paths['matrices']):
+        os.remove(f)
+
+    random = np.random.RandomState(seed)
+    width, height = columns*cellSize, rows*cellSize
+
+    #Grid cells (YKR_IDs grow to the east and to the north) and their centres
+    col, row = np.meshgrid(np.arange(columns), np.arange(rows))
+    col, row = col.ravel(), row.ravel()
+    ykrIds = 5800000 + row*1000 + col
+    cells = [[(c*cellSize, r*cellSize), ((c+1)*cellSize, r*cellSize), ((c+1)*cellSize, (r+1)*cellSize), (c*cellSize, (r+1)*cellSize), (c*cellSize, r*cellSize)]
+             for c, r in zip(col, row)]
+    writeShapefile(paths['grid'], 'Polygon', cells, [{'YKR_ID': int(ykrID)} for ykrID in ykrIds])
+    centres = np.column_stack(((col+0.5)*cellSize, (row+0.5)*cellSize))
+
+    #Sea in the south with a few islands
+    coast = [[(0, -cellSize), (width, -cellSize), (width, 0.15*height), (0.6*width, 0.1*height), (0.3*width, 0.2*height), (0, 0.12*height), (0, -cellSize)]]
+    for i in xrange(5):
+        x, y, r = random.uniform(0.1, 0.9)*width, random.uniform(0.02, 0.12)*height, random.uniform(2, 5)*cellSize
+        angles = np.linspace(0, 2*np.pi, 13)
+        coast.append(list(zip(x + r*np.cos(angles), y + r*np.sin(angles))))
+    writeShapefile(paths['coast'], 'Polygon', coast, [{'id': i} for i in xrange(len(coast))])
+
+    #Roads radiate from the centre of the city (south of the grid centre), metro runs from west to east
+    centre = (0.5*width, 0.25*height)
+    roads = []
+    for angle in np.linspace(0.1, np.pi-0.1, 12):
+        steps = np.linspace(0, 1, 20)
+        roads.append(list(zip(centre[0] + steps*width*np.cos(angle), centre[1] + steps*height*np.sin(angle) + random.normal(0, cellSize, 20))))
+    writeShapefile(paths['roads'], 'LineString', roads, [{'id': i} for i in xrange(len(roads))])
+    metro = [[(0.1*width, 0.3*height), (0.5*width, 0.25*height), (0.9*width, 0.35*height)]]
+    writeShapefile(paths['metro'], 'LineString', metro, [{'id': 0}])
+
+    #Population is denser near the centre, some cells are empty
+    distance = np.hypot(centres[:, 0]-centre[0], centres[:, 1]-centre[1])
+    population = (random.poisson(400, len(ykrIds)) * np.exp(-distance/(0.3*width))).astype(int)
+    population[random.rand(len(ykrIds)) < 0.2] = 0
+    with open(paths['population'], 'w') as f:
+        f.write("YKR_ID;Population\n")
+        f.write("".join("%d;%d\n" % item for item in zip(ykrIds, population) if item[1] > 0))
+
+    #Travel times (minutes) and distances (meters) grow with the distance between the cells, 3 % of the origins have no data
+    destinations = random.choice(len(ykrIds), matrices, replace=False)
+    for d in destinations:
+        distance = np.hypot(centres[:, 0]-centres[d, 0], centres[:, 1]-centres[d, 1]) * random.uniform(1.1, 1.5, len(ykrIds))
+        walkDist = distance.astype(int)
+        ptDist = (distance*1.1).astype(int)
+        carDist = (distance*1.25).astype(int)
+        walkTime = (distance/80).astype(int)
+        ptTime = (distance/300 + random.uniform(2, 8, len(ykrIds))).astype(int)
+        ptTotalTime = ptTime + random.randint(3, 15, len(ykrIds))
+        carTime = (distance/550 + 5).astype(int)
+        data = np.column_stack([ykrIds, np.repeat(ykrIds[d], len(ykrIds)), walkTime, walkDist, ptTotalTime, ptTime, ptDist, carTime, carDist])
+        noData = random.rand(len(ykrIds)) < 0.03
+        data[noData, 2:] = -1
+        np.savetxt(os.path.join(paths['matrices'], "time_to_%d.txt" % ykrIds[d]), data, fmt='%d', delimiter=';', header=";".join(MATRIX_COLUMNS), comments='')
+
+    with open(settingsPath, 'w') as f:
+        json.dump(settings, f)
+    return paths
+
+def timeMapInstance(paths, cacheFolder):
+    """Seconds used for creating MapInstance from the shapefiles and from the geometry cache"""
+    for f in os.listdir(cacheFolder) if os.path.isdir(cacheFolder) else []:
+        os.remove(os.path.join(cacheFolder, f))
+
+    times = {}
+    for name in ['shapefiles', 'cache']:
+        start = time.time()
+        MGC.MapInstance(paths['grid'], paths['coast'], paths['roads'], paths['metro'], cacheFolder)
+        times[name] = time.time()-start
+    return times
+
+def renderMaps(paths, files, outputFolder, cacheFolder, renderer='template', attribute='PT_total_time', classification='10 Minute Equal Intervals', memory=None, memoryLimit=None, dpi=300):
+    """Draws the maps of files one at a time (no background threads). Returns the seconds used for each map.
+    The resident memory (MB) after each map is appended to the list memory if it is given."""
+    if not os.path.isdir(outputFolder):
+        os.makedirs(outputFolder)
+
+    Geometries = MGC.MapInstance(paths['grid'], paths['coast'], paths['roads'], paths['metro'], cacheFolder)
+    MG = MGC.MapGenerator(Geometries.getBasemap(), Geometries.getYkr(), paths['population'], Geometries.getCoast(), Geometries.getRoads(),
+                          Geometries.getMetro(), outputFolder, attribute, classification, Geometries.getCoords(), 10,
+                          renderer=renderer, gridIndex=Geometries.getGridIndex(), memoryLimit=memoryLimit, dpi=dpi)
+    del Geometries
+    seconds = []
+    try:
+        for inputFile in files:
+            start = time.time()
+            result = MG.GenerateMap(inputFile)
+            if isinstance(result, Exception):
+                raise result
+            seconds.append(time.time()-start)
+            if memory != None:
+                memory.append(MGC.residentMemory())
+    finally:
+        MG.flushImages()
+        MG.closeStatistics()
+        MG.closeWriter()
+        if MG.template != None:
+            MG.template.close()
+    return seconds
+
+def timeBatch(paths, files, outputFolder, cacheFolder, renderer='template', workers=1):
+    """Runs the whole batch like the batch command does. Returns (seconds, maps per second)."""
+    Parameters = (paths['matrices'], paths['grid'], paths['population'], paths['coast'], paths['roads'], paths['metro'], outputFolder,
+                  'PT_total_time', '10 Minute Equal Intervals', 10, workers, False)
+    options = {'renderer': renderer, 'journal': False, 'renderCache': False, 'cacheFolder': cacheFolder}
+    if not os.path.isdir(outputFolder):
+        os.makedirs(outputFolder)
+
+    start = time.time()
+    MGB.MapRun(Parameters, files, options).run()
+    seconds = time.time()-start
+    return seconds, len(files)/seconds
+
+def memoryGrowth(paths, files, outputFolder, cacheFolder, renderer='template', maps=2000, warmup=20, memoryLimit=None, dpi=300):
+    """Draws maps (the files over and over again) in one MapGenerator and measures the resident memory after each map.
+    Returns (memory after each map, growth in MB from the warm-up maps to the end of the run)."""
+    memory = []
+    renderMaps(paths, [files[i % len(files)] for i in xrange(maps)], outputFolder, cacheFolder, renderer, memory=memory, memoryLimit=memoryLimit, dpi=dpi)
+    if None in memory or len(memory) <= warmup:
+        return memory, None
+
+    #Median after the warm-up (template, caches and the first allocations) against the largest value of the last maps
+    baseline = np.median(memory[warmup:2*warmup])
+    return memory, max(memory[-warmup:])-baseline
+
+def compareImages(goldenFolder, folder, tolerance=0.1, maxFraction=0.001):
+    """Compares the maps of folder to the golden maps. A map matches if less than maxFraction of its pixels differ by more than
+    tolerance (0-1) in some channel. Returns (file name, largest difference, fraction of differing pixels, matches) for each golden map."""
+    results = []
+    for name in sorted(os.listdir(goldenFolder)):
+        if not name.endswith(".png"):
+            continue
+        path = os.path.join(folder, name)
+        if not os.path.isfile(path):
+            results.append((name, None, None, False))
+            continue
+
+        golden = mimage.imread(os.path.join(goldenFolder, name))
+        image = mimage.imread(path)
+        if image.shape != golden.shape:
+            results.append((name, None, None, False))
+            continue
+
+        difference = np.abs(image - golden).max(axis=2)
+        fraction = (difference > tolerance).mean()
+        results.append((name, float(difference.max()), float(fraction), fraction <= maxFraction))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark MapGenerator with synthetic data.")
+    parser.add_argument("workFolder", help="Folder for the synthetic data and the maps")
+    parser.add_argument("--columns", type=int, default=147, help="Columns of the synthetic grid (default: %(default)s)")
+    parser.add_argument("--rows", type=int, default=90, help="Rows of the synthetic grid (default: %(default)s)")
+    parser.add_argument("--matrices", type=int, default=20, help="Number of travel time matrices (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data (default: %(default)s)")
+    parser.add_argument("--renderer", default='template', choices=['template', 'raster', 'figure'], help="Renderer that is timed (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes of the batch (default: %(default)s)")
+    parser.add_argument("--latency-maps", type=int, default=5, help="Maps drawn for the latency of a single map (default: %(default)s)")
+    parser.add_argument("--golden", help="Folder of the golden images (drawn with the 'figure' renderer if it has none)")
+    parser.add_argument("--golden-maps", type=int, default=3, help="Maps compared to the golden images (default: %(default)s)")
+    parser.add_argument("--skip-batch", action='store_true', help="Do not time the whole batch")
+    parser.add_argument("--long", type=int, default=0, metavar="MAPS", help="Draw this many maps in one process and check that memory does not grow")
+    parser.add_argument("--max-growth", type=float, default=30, help="Memory growth (MB) allowed in the --long run (default: %(default)s)")
+    parser.add_argument("--memory-limit", type=float, help="memoryLimit of the MapGenerator in the --long run (MB, default: no limit)")
+    args = parser.parse_args()
+
+    work = os.path.abspath(args.workFolder)
+    cacheFolder = os.path.join(work, "cache")
+    results = {'renderer': args.renderer, 'workers': args.workers, 'cells': args.columns*args.rows}
+
+    start = time.time()
+    paths = generateData(os.path.join(work, "data"), args.columns, args.rows, args.matrices, args.seed)
+    files = sorted(MGS.matrixFiles(paths['matrices']), key=MGS.destinationId)
+    print "Synthetic data: %d cells, %d matrices (%0.1f s)" % (args.columns*args.rows, len(files), time.time()-start)
+
+    results['mapInstance'] = timeMapInstance(paths, cacheFolder)
+    print "MapInstance: %0.2f s from the shapefiles, %0.2f s from the cache" % (results['mapInstance']['shapefiles'], results['mapInstance']['cache'])
+
+    #First map includes creating the template, the following ones show the steady state
+    seconds = renderMaps(paths, files[:args.latency_maps+1], os.path.join(work, "latency"), cacheFolder, args.renderer)
+    results['latency'] = {'first': seconds[0], 'median': float(np.median(seconds[1:])) if len(seconds) > 1 else None}
+    print "GenerateMap: first map %0.2f s, median %s s" % (seconds[0], "%0.2f" % results['latency']['median'] if len(seconds) > 1 else "-")
+
+    if not args.skip_batch:
+        seconds, rate = timeBatch(paths, files, os.path.join(work, "batch"), cacheFolder, args.renderer, args.workers)
+        results['batch'] = {'maps': len(files), 'seconds': seconds, 'mapsPerSecond': rate}
+        print "Batch: %d maps in %0.1f s (%0.2f maps/s)" % (len(files), seconds, rate)
+
+    if args.golden != None:
+        golden = os.path.abspath(args.golden)
+        goldenFiles = files[:args.golden_maps]
+        if not os.path.isdir(golden) or not any(name.endswith(".png") for name in os.listdir(golden)):
+            print "Drawing golden images with the 'figure' renderer to %s" % golden
+            renderMaps(paths, goldenFiles, golden, cacheFolder, 'figure')
+
+        candidate = os.path.join(work, "golden_" + args.renderer)
+        renderMaps(paths, goldenFiles, candidate, cacheFolder, args.renderer)
+        comparison = compareImages(golden, candidate)
+        results['golden'] = [{'file': name, 'maxDifference': maxDiff, 'differingPixels': fraction, 'matches': bool(ok)} for name, maxDiff, fraction, ok in comparison]
+        for name, maxDiff, fraction, ok in comparison:
+            if maxDiff == None:
+                print "Golden %s: missing or different size" % name
+            else:
+                print "Golden %s: %s (largest difference %0.3f, %0.3f %% of pixels differ)" % (name, "OK" if ok else "DIFFERS", maxDiff, fraction*100)
+
+    if args.long > 0:
+        memory, growth = memoryGrowth(paths, files, os.path.join(work, "long"), cacheFolder, args.renderer, args.long, memoryLimit=args.memory_limit)
+        results['long'] = {'maps': len(memory), 'memoryMB': memory, 'growthMB': growth, 'maxGrowthMB': args.max_growth}
+        if growth == None:
+            print "Long run: %d maps, memory growth could not be measured" % len(memory)
+        else:
+            print "Long run: %d maps, memory %0.0f --> %0.0f MB, growth after the warm-up %0.1f MB (%s)" % (len(memory), memory[0], memory[-1], growth,
+                                                                                                      "OK" if growth <= args.max_growth else "TOO MUCH")
+
+    with open(os.path.join(work, "BenchmarkResults.json"), 'w') as f:
+        json.dump(results, f, indent=1)
+
+    if 'golden' in results and not all(item['matches'] for item in results['golden']):
+        sys.exit(1)
+    if 'long' in results and results['long']['growthMB'] > args.max_growth:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -12,33 +12,411 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
-from matplotlib.collections import PatchCollection
+from matplotlib.collections import PatchCollection, LineCollection
 from matplotlib.colors import Normalize, LinearSegmentedColormap
-from mpl_toolkits.basemap import Basemap
-from shapely.geometry import Polygon, LineString, MultiLineString #Point, MultiPoint, MultiPolygon
-from pysal.esda import mapclassify as mc
-from pysal.esda.mapclassify import Natural_Breaks as nb
-from pysal.esda.mapclassify import Fisher_Jenks as fj
-from pysal.esda.mapclassify import Quantiles
-from descartes import PolygonPatch
-import fiona, sys, time, os
+from matplotlib.figure import Figure
+from matplotlib.transforms import TransformNode
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import sys, time, os, gc, hashlib, threading, Queue, json, zlib, glob
+import cPickle as pickle
 from itertools import chain, imap
+from collections import OrderedDict
 import matplotlib.gridspec as gridspec
+import MetropAccess_MapGenerator_store as MGS
+import MetropAccess_MapGenerator_writer as MGW
+
+#psutil is optional (peak memory of the maps is read from /proc without it)
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+#Basemap, fiona and shapely (reading the shapefiles), descartes (drawing) and pysal (the 'pysal' classifier) are slow to import
+#--> they are imported in the functions that use them, so that statistics-only runs and worker processes start quickly
+
+#Header of the travel time statistics files
+STATISTICS_HEADER = "YKR_ID;mean;median;std;min;max\n"
+
+def parseShard(text):
+    """Parses a shard given as "i/n" (shard i of n, numbered 1..n). Returns (i, n)."""
+    try:
+        i, n = [int(part) for part in text.split('/')]
+    except ValueError:
+        raise ValueError("Shard '%s' is not in the form i/n" % text)
+    if n < 1 or not 1 <= i <= n:
+        raise ValueError("Shard %d/%d is not valid (shards are numbered 1..%d)" % (i, n, n))
+    return i, n
+
+def shardSuffix(shard):
+    #File name suffix of the statistics, journal and manifest files of a shard ((i, n) --> ".shard<i>of<n>", None --> "")
+    if shard == None:
+        return ""
+    return ".shard%dof%d" % tuple(shard)
+
+def shardFiles(files, shard, method='hash'):
+    """Files (destinations) that belong to shard (i, n). 'hash' spreads the YKR_IDs evenly over the shards, 'range' gives
+    each shard a contiguous range of YKR_IDs. The partition depends only on the YKR_IDs, so every machine gets the same one."""
+    if shard == None:
+        return list(files)
+    i, n = shard
+    ids = [MGS.destinationId(f) for f in files]
+    if method == 'hash':
+        #crc32 is the same on every platform and Python version (hash() is not)
+        return [f for f, ykrID in zip(files, ids) if (zlib.crc32(str(ykrID)) & 0xffffffff) % n == i-1]
+    elif method == 'range':
+        chosen = set(np.array_split(np.unique(ids), n)[i-1])
+        return [f for f, ykrID in zip(files, ids) if ykrID in chosen]
+    raise ValueError("Unknown shard method '%s' (use 'hash' or 'range')" % method)
+
+def statisticsPath(outputFolder, attribute, shard=None):
+    #Travel time statistics file of an attribute (or its fragment written by a shard)
+    MeanName = "MeanTravelTimes_" + attribute + shardSuffix(shard) + ".csv"
+    return os.path.join(outputFolder, MeanName)
+
+def openStatistics(outputFolder, attribute, shard=None):
+    """Opens the travel time statistics file (MeanTravelTimes_<attribute>.csv) for appending"""
+
+    #Create outputfile for travel time statistics
+    meanTimes = statisticsPath(outputFolder, attribute, shard)
+
+    if os.path.isfile(meanTimes):
+        exists = True
+    else:
+        exists = False
+
+    statistics = open(meanTimes, 'a')
+
+    #Write header if file does not exist already
+    if exists == False:
+        statistics.write(STATISTICS_HEADER)
+
+    return statistics
+
+def writeStatisticsTable(outputFolder, attribute, rows, shard=None):
+    """Writes the statistics file of an attribute at once. Rows of the existing file are kept unless rows has a new row
+    for the same YKR_ID, so the file never has duplicate rows."""
+    path = statisticsPath(outputFolder, attribute, shard)
+
+    table = OrderedDict()
+    if os.path.isfile(path):
+        with open(path) as f:
+            for line in f.readlines()[1:]:
+                if line.strip() != "":
+                    table[line.split(';')[0]] = line.rstrip('\n') + '\n'
+    for row in rows:
+        table[row.split(';')[0]] = row
+
+    #Write to a temporary file first so that the old file stays complete until the new one is ready
+    tmpPath = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmpPath, 'w') as f:
+        f.write(STATISTICS_HEADER)
+        f.write("".join(table.values()))
+    MGW.replaceFile(tmpPath, path)
+
+def writeStatisticsBinary(outputFolder, attribute, shard=None):
+    """Writes a columnar copy of the statistics file (MeanTravelTimes_<attribute>.npz with arrays YKR_ID, mean, median, std, min, max)
+    that loads much faster than the text file"""
+    path = statisticsPath(outputFolder, attribute, shard)
+    table = pd.read_csv(path, sep=';')
+    columns = dict((column, table[column].values.astype(float)) for column in table.columns if column != 'YKR_ID')
+    columns['YKR_ID'] = table['YKR_ID'].values.astype(np.int64)
+
+    #np.savez adds .npz to the file name
+    npzPath = path[:-4] + ".npz"
+    tmpPath = "%s.%d.tmp" % (npzPath[:-4], os.getpid())
+    np.savez(tmpPath, **columns)
+    MGW.replaceFile(tmpPath + ".npz", npzPath)
+
+def mergeStatistics(outputFolder, attribute, binary=False):
+    """Combines the statistics fragments of the shards (MeanTravelTimes_<attribute>.shard<i>of<n>.csv) and the existing
+    statistics file to MeanTravelTimes_<attribute>.csv in YKR_ID order. Returns (number of rows, number of fragments)."""
+    path = statisticsPath(outputFolder, attribute)
+    pattern = statisticsPath(outputFolder, attribute).replace(".csv", ".shard*of*.csv")
+    fragments = sorted(glob.glob(pattern))
+    if len(fragments) == 0:
+        raise IOError("No statistics fragments (%s) in %s" % (os.path.basename(pattern), outputFolder))
+
+    #Rows of the fragments replace the rows of the same YKR_ID in the existing file
+    table = {}
+    for fragment in [path] + fragments:
+        if os.path.isfile(fragment):
+            with open(fragment) as f:
+                for line in f.readlines()[1:]:
+                    if line.strip() != "":
+                        table[int(line.split(';')[0])] = line.rstrip('\n') + '\n'
+
+    tmpPath = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmpPath, 'w') as f:
+        f.write(STATISTICS_HEADER)
+        f.write("".join(table[ykrID] for ykrID in sorted(table.keys())))
+    MGW.replaceFile(tmpPath, path)
+
+    if binary:
+        writeStatisticsBinary(outputFolder, attribute)
+    return len(table), len(fragments)
+
+class StatisticsSink:
+    """Statistics files of a run (one per attribute). Each file is opened once, rows are kept in memory and written in batches
+    (every flushRows rows or flushSeconds seconds). Rows can be written from several threads at once.
+    With binary=True a columnar copy of each file is written when the sink is closed (see writeStatisticsBinary).
+    A shard (i, n) writes to its own fragments of the files (see mergeStatistics)."""
+    def __init__(self, outputFolder, attributes, flushRows=500, flushSeconds=30, binary=False, shard=None):
+        """Constructor"""
+        self.outputFolder = outputFolder
+        self.attributes = list(attributes)
+        self.flushRows = flushRows
+        self.flushSeconds = flushSeconds
+        self.binary = binary
+        self.shard = shard
+
+        self.lock = threading.Lock()
+        self.files = dict((attribute, openStatistics(outputFolder, attribute, shard)) for attribute in self.attributes)
+        self.buffer = dict((attribute, []) for attribute in self.attributes)
+        self.buffered = 0
+        self.lastFlush = time.time()
+
+    def write(self, attribute, row):
+        self.writeRows([(attribute, row)])
+
+    def writeRows(self, rows):
+        """Adds (attribute, row) pairs to the buffer"""
+        with self.lock:
+            for attribute, row in rows:
+                self.buffer[attribute].append(row)
+            self.buffered += len(rows)
+            if self.buffered >= self.flushRows or time.time()-self.lastFlush >= self.flushSeconds:
+                self._flush()
+
+    def _flush(self):
+        #Write the buffered rows (lock is held by the caller)
+        for attribute in self.attributes:
+            if len(self.buffer[attribute]) > 0:
+                self.files[attribute].write("".join(self.buffer[attribute]))
+                self.files[attribute].flush()
+                self.buffer[attribute] = []
+        self.buffered = 0
+        self.lastFlush = time.time()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        with self.lock:
+            if self.files == None:
+                return
+            self._flush()
+            for f in self.files.values():
+                f.close()
+            self.files = None
+
+        if self.binary:
+            for attribute in self.attributes:
+                writeStatisticsBinary(self.outputFolder, attribute, self.shard)
+
+class ShapeArrays:
+    """Coordinates of a layer (e.g. road lines) stored in one contiguous array: part i is coords[offsets[i]:offsets[i+1]]"""
+    def __init__(self, parts):
+        """Constructor, parts is a list of xy-coordinate sequences"""
+        lengths = [len(xy) for xy in parts]
+        self.offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        if len(parts) > 0:
+            self.coords = np.concatenate([np.asarray(xy, dtype=float).reshape(-1, 2) for xy in parts])
+        else:
+            self.coords = np.zeros((0, 2))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def parts(self):
+        #Parts as views to the coordinate array (suitable for LineCollection)
+        return [self.coords[self.offsets[i]:self.offsets[i+1]] for i in xrange(len(self))]
+
+#Projection of the maps (Basemap parameters)
+PROJECTION = {'projection': 'tmerc',
+              'lon_0': 24.8, #Central longitude
+              'lat_0': 60.25, #Central latitude
+              'ellps': 'WGS84',
+              'lat_ts': 0,
+              'resolution': 'l'} #Resolution of boundary database to use. Can be c (crude), l (low), i (intermediate), h (high), f (full) or None.
+
+#Version of the geometry cache contents (change when MapInstance stores something new)
+GEOMETRY_CACHE_VERSION = 2
+
+def defaultCacheFolder():
+    """Folder for cached geometries (in the home directory of the user)"""
+    return os.path.join(os.path.expanduser('~'), '.MetropAccess_MapGenerator')
+
+def geometryCacheKey(Ykr, Coast, Roads, Metro):
+    #Cache is valid as long as the shapefiles (path, size, modification time) and projection parameters stay the same
+    key = repr((GEOMETRY_CACHE_VERSION, sorted(PROJECTION.items()),
+                [fileSignature(f) for f in [Ykr, Coast, Roads, Metro]]))
+    return hashlib.sha1(key).hexdigest()
+
+def gridIndexPath(cacheFolder, key):
+    #Grid index is cached also in its own file (it is read without the geometries, see loadGridIndex)
+    return os.path.join(cacheFolder, "GridIndex_" + key + ".pkl")
+
+def loadGridIndex(Ykr, Coast, Roads, Metro, cacheFolder=None):
+    """Returns the YKR_ID index of the grid (see GridIndex). If the geometry cache exists only the index is read
+    (Basemap, shapely and fiona are not imported), otherwise the MapInstance is created."""
+    if cacheFolder != None:
+        path = gridIndexPath(cacheFolder, geometryCacheKey(Ykr, Coast, Roads, Metro))
+        if os.path.isfile(path):
+            try:
+                with open(path, 'rb') as f:
+                    return pickle.load(f)
+            except Exception as e:
+                print "Could not read grid index cache %s: %s" % (path, e)
+
+    #Creating the MapInstance writes the grid index to the cache
+    return MapInstance(Ykr, Coast, Roads, Metro, cacheFolder).getGridIndex()
+
+def fileSignature(path):
+    #Path, size and modification time of a file and its shapefile companions (.shx, .dbf, .prj)
+    signature = []
+    for ext in ['', '.shx', '.dbf', '.prj']:
+        if ext == '':
+            f = os.path.abspath(path)
+        else:
+            f = os.path.abspath(path[:-4] + ext)
+        if os.path.isfile(f):
+            stat = os.stat(f)
+            signature.append((f, stat.st_size, int(stat.st_mtime)))
+    return signature
+
+def inputSignature(files, matrixStore=None):
+    """Signature of the travel time matrices: path, size and modification time of the matrix files (or of the files of a matrix store)"""
+    if matrixStore != None:
+        files = [os.path.join(matrixStore, name) for name in sorted(os.listdir(matrixStore))]
+    signature = []
+    for f in files:
+        if os.path.isfile(f):
+            stat = os.stat(f)
+            signature.append((os.path.abspath(f), stat.st_size, int(stat.st_mtime)))
+    return hashlib.sha1(repr(signature)).hexdigest()
+
+class GridIndex:
+    """Dense YKR_ID --> grid row lookup table and the centroids of the grid cells (built once per grid)"""
+    def __init__(self, ykrIds, polys):
+        """Constructor, ykrIds and polys (shapely polygons) are in the order of the grid"""
+        self.ids = np.asarray(ykrIds, dtype=np.int64)
+
+        #lookup[YKR_ID - base] is the grid row of YKR_ID (-1 if it is not in the grid)
+        self.base = self.ids.min()
+        self.lookup = np.full(self.ids.max() - self.base + 1, -1, dtype=np.int32)
+        self.lookup[self.ids - self.base] = np.arange(len(self.ids), dtype=np.int32)
+
+        #Centroids of the cells (target point of the maps)
+        self.centroids = np.array([(p.centroid.x, p.centroid.y) for p in polys])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def rows(self, ykrIds):
+        """Grid rows of an array of YKR_IDs (-1 for the ids that are not in the grid)"""
+        ids = np.asarray(ykrIds, dtype=np.int64) - self.base
+        inside = (ids >= 0) & (ids < len(self.lookup))
+        rows = np.full(len(ids), -1, dtype=np.int32)
+        rows[inside] = self.lookup[ids[inside]]
+        return rows
+
+    def row(self, ykrID):
+        return self.rows([ykrID])[0]
+
+    def align(self, ykrIds, values):
+        """Values of the origins (ykrIds) in the order of the grid, cells without a value are NaN"""
+        rows = self.rows(ykrIds)
+        inGrid = rows >= 0
+        aligned = np.empty(len(self.ids))
+        aligned.fill(np.nan)
+        aligned[rows[inGrid]] = np.asarray(values, dtype=float)[inGrid]
+        return aligned
 
 class MapInstance:
-    """Creates and returns Basemap map instance from input shapefiles"""
-    def __init__(self, Ykr, Coast, Roads, Metro):
+    """Creates and returns Basemap map instance from input shapefiles.
+    If cacheFolder is given, projected geometries are stored there and loaded on the following runs."""
+    def __init__(self, Ykr, Coast, Roads, Metro, cacheFolder=None):
         """Constructor"""
         self.Ykr = Ykr
         self.Coast = Coast
         self.Roads = Roads
         self.Metro = Metro
         self.coords = None
+        self.cacheFolder = cacheFolder
+
+        #Create map-instances (or load them from the cache)
+        if not self.loadCache():
+            self.createMapInstances()
+            self.saveCache()
+
+    def cacheKey(self):
+        return geometryCacheKey(self.Ykr, self.Coast, self.Roads, self.Metro)
 
-        #Create map-instances
-        self.createMapInstances()
+    def cachePath(self):
+        return os.path.join(self.cacheFolder, "MapInstance_" + self.cacheKey() + ".pkl")
+
+    def loadCache(self):
+        #Returns True if geometries were loaded from the cache
+        if self.cacheFolder == None:
+            return False
+
+        path = self.cachePath()
+        if not os.path.isfile(path):
+            return False
+
+        try:
+            with open(path, 'rb') as f:
+                cache = pickle.load(f)
+        except Exception as e:
+            print "Could not read geometry cache %s: %s" % (path, e)
+            return False
+
+        self.m = cache['m']
+        self.coords = cache['coords']
+        self.grid_map = cache['grid_map']
+        self.coast_map = cache['coast_map']
+        self.metroLines = cache['metro']
+        self.roads = cache['roads']
+        self.gridIndex = cache['gridIndex']
+
+        #Caches written before the grid index had its own file
+        if not os.path.isfile(gridIndexPath(self.cacheFolder, self.cacheKey())):
+            self.saveGridIndex()
+        return True
+
+    def saveCache(self):
+        if self.cacheFolder == None:
+            return
+
+        if not os.path.isdir(self.cacheFolder):
+            os.makedirs(self.cacheFolder)
+
+        cache = {'m': self.m,
+                 'coords': self.coords,
+                 'grid_map': self.grid_map,
+                 'coast_map': self.coast_map,
+                 'metro': self.metroLines,
+                 'roads': self.roads,
+                 'gridIndex': self.gridIndex}
+
+        self.writeCacheFile(self.cachePath(), cache)
+        self.saveGridIndex()
+
+    def saveGridIndex(self):
+        self.writeCacheFile(gridIndexPath(self.cacheFolder, self.cacheKey()), self.gridIndex)
+
+    def writeCacheFile(self, path, data):
+        #Write to a temporary file first so that other processes never read a half written cache
+        tmpPath = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmpPath, 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        MGW.replaceFile(tmpPath, path)
 
     def createMapInstances(self):
+        import fiona
+        from mpl_toolkits.basemap import Basemap
+        from shapely.geometry import Polygon #Point, MultiPoint, MultiPolygon, LineString, MultiLineString
 
         #Import GRID-shapefile
         shp = fiona.open(self.Ykr)
@@ -58,22 +436,18 @@ class MapInstance:
 
         #Create basemap instance
         m = Basemap(
-            projection='tmerc',
-            lon_0=24.8, #Central longitude
-            lat_0=60.25, #Central latitude
-            ellps = 'WGS84',
             llcrnrlon=self.coords[0] - extra * w,
             llcrnrlat=self.coords[1] - extra + 0.02 * h,  #Set more empty space under the figure
             urcrnrlon=self.coords[2] + extra * w,
             urcrnrlat=self.coords[3] + extra + 0.01 * h,
-            lat_ts=0,
-            resolution='l',         #Resolution of boundary database to use. Can be c (crude), l (low), i (intermediate), h (high), f (full) or None.
-            suppress_ticks=True)
+            suppress_ticks=True,
+            **PROJECTION)
 
         #Read GRID-shapefiles in
         m.readshapefile(
             self.Ykr[:-4],
             'Helsinki',
+            drawbounds=False,
             color='none',
             zorder=2)
 
@@ -81,6 +455,7 @@ class MapInstance:
         m.readshapefile(
             self.Coast[:-4],
             'Coast',
+            drawbounds=False,
             color='none',
             zorder=2)
 
@@ -88,6 +463,7 @@ class MapInstance:
         m.readshapefile(
             self.Metro[:-4],
             'Metro',
+            drawbounds=False,
             color='none',
             zorder=2)
 
@@ -95,6 +471,7 @@ class MapInstance:
         m.readshapefile(
             self.Roads[:-4],
             'Roads',
+            drawbounds=False,
             color='none',
             zorder=2)
 
@@ -108,24 +485,28 @@ class MapInstance:
             'YKR_ID': [Yid['YKR_ID'] for Yid in m.Helsinki_info]})
         #grid = shapely.prepared.prep(MultiPolygon(list(grid_map['poly'].values))) #Prepared geometries instances have the following methods: contains, contains_properly, covers, and intersects.
 
+        #YKR_ID --> grid row lookup and cell centroids (replace joins with the grid for every map)
+        self.gridIndex = GridIndex(self.grid_map['YKR_ID'].values, self.grid_map['poly'].values)
+
         #Coastline
         self.coast_map = pd.DataFrame({
             'poly': [Polygon(xy) for xy in m.Coast]})
 
-        #Metro
-        metro_map = pd.DataFrame({
-            'line': [LineString(xy) for xy in m.Metro]})
-        self.metroLines = MultiLineString(list(metro_map['line'].values)) #Create a MultiLine object from individual lines
+        #Metro and main roads as contiguous coordinate arrays (drawn as one LineCollection per layer)
+        self.metroLines = ShapeArrays(m.Metro)
+        self.roads = ShapeArrays(m.Roads)
 
-        #Main roads
-        roads_map = pd.DataFrame({
-            'line': [LineString(xy) for xy in m.Roads]})
-        self.roads = MultiLineString(list(roads_map['line'].values))
+        #Shapefile contents are not needed in the Basemap instance anymore (keeps it small for the cache)
+        for name in ['Helsinki', 'Coast', 'Metro', 'Roads']:
+            delattr(m, name)
+            delattr(m, name + '_info')
 
     def getBasemap(self):
         return self.m
     def getYkr(self):
         return self.grid_map
+    def getGridIndex(self):
+        return self.gridIndex
     def getCoast(self):
         return self.coast_map
     def getMetro(self):
@@ -135,9 +516,730 @@ class MapInstance:
     def getCoords(self):
         return self.coords
 
+#---------------------------------------------
+#CLASSIFICATION
+#---------------------------------------------
+
+#Classification methods where the class breaks are calculated from the data
+DATA_DRIVEN = ['Natural Breaks', 'Quantiles', "Fisher's Jenks"]
+
+def binClasses(values, bins):
+    """Classes of values for bins (upper bounds of the classes) and the count of values in each class.
+    Same as pysal's bin1d: class i contains bins[i-1] < value <= bins[i], values above the highest bin get class 0.
+    values can be a 2D block (one row per map), counts are then counted for each row."""
+    bins = np.asarray(bins)
+    yb = np.searchsorted(bins, values, side='left')
+    yb[yb == len(bins)] = 0
+    if yb.ndim == 1:
+        counts = np.bincount(yb, minlength=len(bins))
+    else:
+        counts = np.array([np.bincount(row, minlength=len(bins)) for row in yb])
+    return yb, counts
+
+def manualBins(attribute, classification, Nclasses, maxBin):
+    """Bins of the equal interval classifications. Returns bins (list) and 'higher than' info for the colorbar."""
+
+    if "time" in attribute:
+
+        if classification == "10 Minute Equal Intervals":
+
+            #Calculate the highest class (10 minutes * Number of classes)
+            maxClass = 10*Nclasses
+
+            #Create 'higher than' info for the colorbar
+            maxClassInfo = str(maxClass-10)
+
+            #Create array of bins from 0 to highest class with increments of 10
+            bins = np.arange(10, maxClass, 10)
+
+        elif classification == "5 Minute Equal Intervals":
+
+            #Calculate the highest class (10 minutes * Number of classes)
+            maxClass = 5*Nclasses
+
+            #Create 'higher than' info for the colorbar
+            maxClassInfo = str(maxClass-5)
+
+            #Create array of bins from 0 to highest class with increments of 5
+            bins = np.arange(5, maxClass, 5)
+
+        else:
+            raise ValueError("Classification method '%s' does not match with travel mode '%s'" % (classification, attribute))
+
+    elif "dist" in attribute:
+
+        if classification == "5 Km Equal Intervals":
+
+            #Calculate the highest class (5000 meters * Number of classes)
+            maxClass = 5000*Nclasses
+
+            #Create 'higher than' info for the colorbar
+            maxClassInfo = str((maxClass-5000)/1000)
+
+            #Create array of bins from 0 to highest class with increments of 5000 (meters)
+            bins = np.arange(5000, maxClass, 5000)
+
+        elif classification == "10 Km Equal Intervals":
+
+            #Calculate the highest class (5000 meters * Number of classes)
+            maxClass = 10000*Nclasses
+
+            #Create 'higher than' info for the colorbar
+            maxClassInfo = str((maxClass-10000)/1000)
+
+            #Create array of bins from 0 to highest class with increments of 5000 (meters)
+            bins = np.arange(0, maxClass, 10000)
+
+        else:
+            raise ValueError("Classification method '%s' does not match with travel mode '%s'" % (classification, attribute))
+
+    else:
+        raise ValueError("Unknown travel mode '%s'" % attribute)
+
+    #Add extra classes for No Data and higher than maxClass values
+    if maxBin < maxClass:
+        bins = list(np.append(bins, [maxClass+1, maxClass+2]))
+    else:
+        bins = list(np.append(bins, [maxBin, maxBin+1]))
+
+    return bins, maxClassInfo
+
+#Engines of the data driven classifications: 'fast' classifies the histogram of the distinct values (travel times and distances
+#are integers, so a map has a few hundred or thousand distinct values instead of 13 230 cells), 'pysal' uses pysal's classifiers
+CLASSIFIERS = ['fast', 'pysal']
+
+#Breaks of the 'fast' engine by histogram (the same data is classified again e.g. when a run is restarted or maps are drawn again)
+BREAKS_CACHE = {}
+BREAKS_CACHE_SIZE = 1000
+
+def valueHistogram(values, sample=None):
+    """Distinct values (sorted) and their counts. With sample (number of values) the histogram is made of a random sample
+    of the values (the same sample for the same data) that always includes the smallest and the largest value."""
+    values = np.asarray(values)
+    if sample != None and sample < len(values):
+        order = np.random.RandomState(len(values)).permutation(len(values))[:max(sample-2, 0)]
+        values = np.concatenate([values[order], [values.min(), values.max()]])
+    return np.unique(values, return_counts=True)
+
+def histogramQuantiles(distinct, counts, k):
+    """Quantile breaks of a histogram, the same as pysal's quantile (scipy's scoreatpercentile of the values)"""
+    cumulative = np.cumsum(counts)
+    n = cumulative[-1]
+    w = 100. / k
+    p = np.arange(w, 100 + w, w)
+    if p[-1] > 100.0:
+        p[-1] = 100.0
+
+    q = []
+    for pct in p:
+        #Value at position i of the sorted values is the first distinct value whose cumulative count is above i
+        idx = pct / 100. * (n - 1)
+        i = int(idx)
+        low = distinct[np.searchsorted(cumulative, i, side='right')]
+        if i == idx:
+            q.append(float(low))
+        else:
+            high = distinct[np.searchsorted(cumulative, i + 1, side='right')]
+            q.append((low * (i + 1 - idx) + high * (idx - i)) / ((i + 1 - idx) + (idx - i)))
+    return np.unique(q)
+
+def histogramFisherJenks(distinct, counts, k):
+    """Exact Fisher-Jenks breaks (classes with the smallest sum of squared deviations) of a histogram. Returns the upper bounds
+    of the k classes like pysal's Fisher_Jenks. The best start of the last class never moves left when the data grows,
+    so each class count is solved level by level for all the ends at once (divide and conquer) instead of for each pair of values."""
+    distinct = np.asarray(distinct, dtype=float)
+    m = len(distinct)
+    if m <= k:
+        return distinct.copy()
+
+    #Cumulative weight, sum and sum of squares --> squared deviations of any run of distinct values
+    W = np.concatenate([[0.], np.cumsum(counts, dtype=float)])
+    S = np.concatenate([[0.], np.cumsum(distinct*counts)])
+    Q = np.concatenate([[0.], np.cumsum(distinct*distinct*counts)])
+    def deviations(i, j):
+        #Values i..j (inclusive)
+        s = S[j+1]-S[i]
+        return (Q[j+1]-Q[i]) - s*s/(W[j+1]-W[i])
+
+    ends = np.arange(m)
+    cost = deviations(np.zeros(m, dtype=int), ends)
+    starts = []
+    for c in xrange(1, k):
+        #Best cost of values 0..j in c+1 classes and the start of the last class
+        best = np.empty(m)
+        start = np.zeros(m, dtype=int)
+        best[:c] = np.inf
+
+        #Intervals of ends (jlo..jhi) whose last class starts in ilo..ihi
+        jlo, jhi, ilo, ihi = np.array([c]), np.array([m-1]), np.array([c]), np.array([m-1])
+        while len(jlo) > 0:
+            mid = (jlo + jhi) // 2
+            lengths = np.minimum(ihi, mid) - ilo + 1
+            offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+            segment = np.repeat(np.arange(len(mid)), lengths)
+            i = ilo[segment] + np.arange(lengths.sum()) - offsets[segment]
+            candidates = cost[i-1] + deviations(i, mid[segment])
+
+            #Smallest start with the lowest cost in each segment
+            lowest = np.minimum.reduceat(candidates, offsets)
+            positions = np.where(candidates == lowest[segment], np.arange(len(i)), len(i))
+            chosen = i[np.minimum.reduceat(positions, offsets)]
+            best[mid] = lowest
+            start[mid] = chosen
+
+            left = mid > jlo
+            right = mid < jhi
+            jlo, jhi, ilo, ihi = (np.concatenate([jlo[left], mid[right]+1]), np.concatenate([mid[left]-1, jhi[right]]),
+                                  np.concatenate([ilo[left], chosen[right]]), np.concatenate([chosen[left], ihi[right]]))
+        cost = best
+        starts.append(start)
+
+    #Ends of the classes from the last class backwards
+    bins = [distinct[-1]]
+    end = m-1
+    for start in reversed(starts):
+        end = start[end]-1
+        bins.append(distinct[end])
+    return np.array(bins[::-1])
+
+class Breaks:
+    """Class breaks of the 'fast' engine with the same attributes as pysal's classifiers: bins, classes (yb) and counts"""
+    def __init__(self, values, bins):
+        self.bins = np.array(bins, dtype=float)
+        self.k = len(self.bins)
+        self.yb, self.counts = binClasses(values, self.bins)
+
+def fastBreaks(values, classification, Nclasses, sample=None):
+    """Class breaks from the histogram of the values. Natural Breaks is solved exactly with Fisher-Jenks (pysal's Natural_Breaks
+    searches the same optimum with repeated k-means)."""
+    distinct, counts = valueHistogram(values, sample)
+    key = hashlib.sha1(distinct.tostring() + counts.tostring() + repr((classification, Nclasses, sample))).hexdigest()
+    bins = BREAKS_CACHE.get(key)
+    if bins is None:
+        if classification == 'Quantiles':
+            bins = histogramQuantiles(distinct, counts, Nclasses)
+        elif classification in ['Natural Breaks', "Fisher's Jenks"]:
+            bins = histogramFisherJenks(distinct, counts, Nclasses)
+        else:
+            raise ValueError("Unknown classification method '%s'" % classification)
+        if len(BREAKS_CACHE) >= BREAKS_CACHE_SIZE:
+            BREAKS_CACHE.clear()
+        BREAKS_CACHE[key] = bins
+    return Breaks(values, bins)
+
+def dataDrivenBreaks(values, classification, Nclasses, classifier='fast', sample=None):
+    """Class breaks calculated from the data ('fast' engine or pysal classifiers, see CLASSIFIERS)"""
+    if classifier == 'fast':
+        return fastBreaks(values, classification, Nclasses, sample)
+    elif classifier != 'pysal':
+        raise ValueError("Unknown classifier '%s' (use one of %s)" % (classifier, ", ".join(CLASSIFIERS)))
+
+    from pysal.esda.mapclassify import Natural_Breaks as nb
+    from pysal.esda.mapclassify import Fisher_Jenks as fj
+    from pysal.esda.mapclassify import Quantiles
+
+    if classification == 'Natural Breaks':
+        return nb(values,initial=100, k=Nclasses)
+    elif classification == 'Quantiles':
+        return Quantiles(values, k=Nclasses)
+    elif classification == "Fisher's Jenks":
+        return fj(values, k=Nclasses)
+    raise ValueError("Unknown classification method '%s'" % classification)
+
+def mergeHistograms(first, second):
+    #Sum of two histograms (distinct values, counts)
+    distinct, inverse = np.unique(np.concatenate([first[0], second[0]]), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate([first[1], second[1]])).astype(np.int64)
+    return distinct, counts
+
+def sharedBreaks(files, gridIndex, mapList, Nclasses, matrixStore=None, sample=None, blockSize=256):
+    """Class breaks of the data driven classifications shared by all maps of a run (the maps can be compared and they are not
+    classified one by one). Travel times/distances of the files (or of a random sample of sample files) are collected to one
+    histogram per travel mode (NoData is left out) and classified with the 'fast' engine. Returns {(attribute, classification): bins}."""
+    pairs = [(attribute, classification) for attribute, classification in mapList if classification in DATA_DRIVEN]
+    if len(pairs) == 0:
+        return {}
+
+    files = list(files)
+    if sample != None and sample < len(files):
+        chosen = np.random.RandomState(len(files)).permutation(len(files))[:sample]
+        files = [files[i] for i in sorted(chosen)]
+
+    #Matrices are read in blocks like for the statistics
+    attributes = sorted(set(attribute for attribute, classification in pairs))
+    reader = StatisticsGenerator(gridIndex, None, attributes, matrixStore, blockSize)
+    histograms = dict((attribute, (np.array([]), np.array([], dtype=np.int64))) for attribute in attributes)
+    for start in xrange(0, len(files), blockSize):
+        ykrIds, values = reader.readBlock(files[start:start+blockSize])
+        for attribute in attributes:
+            data = values[attribute]
+            histograms[attribute] = mergeHistograms(histograms[attribute], np.unique(data[~np.isnan(data)], return_counts=True))
+
+    breaks = {}
+    for attribute, classification in pairs:
+        distinct, counts = histograms[attribute]
+        if len(distinct) == 0:
+            raise ValueError("No travel times/distances of %s for the shared class breaks" % attribute)
+        if classification == 'Quantiles':
+            bins = histogramQuantiles(distinct, counts, Nclasses)
+        else:
+            bins = histogramFisherJenks(distinct, counts, Nclasses)
+        breaks[(attribute, classification)] = [float(b) for b in bins]
+    return breaks
+
+class Classification:
+    """Classes, colour values (0.0-1.0) and legend labels of one map. values are in the order of the grid, NoData as NaN."""
+    def __init__(self, values, attribute, classification, Nclasses, classifier='fast', sample=None, shared=None):
+        """Constructor, classes of the equal interval classifications are set with setClasses (see classify).
+        classifier and sample are the engine of the data driven classifications (see dataDrivenBreaks), shared are
+        the class breaks of the whole run (see sharedBreaks) that are used instead of the breaks of this map."""
+        self.attribute = attribute
+        self.classification = classification
+        self.Nclasses = Nclasses
+
+        #NoData mask is computed only once
+        self.isNull = np.isnan(values)
+        self.maxBin = values[~self.isNull].max()
+        self.NoData = int(self.maxBin+1)
+        self.NullP = (self.isNull.sum()/13230.0)*100
+
+        #Fill NoData values with maxBin+1 value
+        self.filled = np.where(self.isNull, self.NoData, values)
+
+        if "time" in attribute:
+            self.measure = "min"
+            self.measure2 = "minutes" #Another string-form for summary
+            self.titleMeas = "time"
+        else:
+            self.measure = "km"
+            self.measure2 = "kilometers"
+            self.titleMeas = "distance"
+
+        self.Manual = not classification in DATA_DRIVEN
+        self.shared = shared != None and not self.Manual
+        self.classes = None
+
+        if self.Manual:
+            #Create bins for classification based on chosen classification method
+            self.bins, self.maxClassInfo = manualBins(attribute, classification, Nclasses, self.maxBin)
+
+            #Values above the highest bin get a class of their own (like in pysal's User_Defined)
+            if self.bins[-1] < self.filled.max():
+                self.bins.append(self.filled.max())
+            self.classBins = self.bins
+
+        elif self.shared:
+            #Legend shows the shared breaks. In the classification the last class reaches the values and the NoData of this map,
+            #NoData cells are always in the last class (like NoData that is the largest value when the breaks are calculated from the map).
+            self.bins = [float(b) for b in shared]
+            self.classBins = np.array(self.bins)
+            self.classBins[-1] = max(self.classBins[-1], self.NoData)
+
+            if "time" in attribute:
+                self.maxClassInfo = str(self.bins[-2])
+            else:
+                self.maxClassInfo = str(self.bins[-2]/1000)
+
+            self.bins.append(self.maxBin)
+            self.bins.append(self.maxBin)
+
+            classes = binClasses(self.filled, self.classBins)[0]
+            classes[self.isNull] = len(self.classBins)-1
+            self.setClasses(classes, np.bincount(classes, minlength=len(self.classBins)))
+
+        else:
+            breaks = dataDrivenBreaks(self.filled, classification, Nclasses, classifier, sample)
+            self.classBins = breaks.bins
+            self.bins = list(breaks.bins)
+
+            if "time" in attribute:
+                self.maxClassInfo = str(self.bins[-2])
+            else:
+                self.maxClassInfo = str(self.bins[-2]/1000)
+
+            self.bins.append(self.maxBin)
+            self.bins.append(self.maxBin)
+
+            self.setClasses(breaks.yb, breaks.counts)
+
+    def setClasses(self, classes, counts):
+        """Sets the classes of the grid cells and creates colour values and labels"""
+        self.classes = classes
+        self.counts = counts
+
+        #Reclassify data to value range 0.0-1.0 (--> colorRange is 0.0-1.0)
+        if self.Manual:
+            colbins = np.linspace(0.0,1.0, len(self.bins))
+            colbins = colbins-0.001
+            colbins[0], colbins[-1] = 0.0001, 1.0
+            self.colorValues = colbins[classes]
+        elif self.shared:
+            #Same colours for the same classes in all maps
+            norm = Normalize(0, max(len(self.classBins)-1, 1))
+            self.colorValues = norm(classes)
+        else:
+            norm = Normalize()
+            self.colorValues = norm(classes)
+
+        self.labels = self.classLabels()
+
+    def classLabels(self):
+        #Labels for the colour bar
+        bins = self.bins
+        brksBins = bins[:-1]#breaks.bins[:-1] #Do not take into account NoData values
+
+        if self.measure2 == "kilometers": #Convert meters (in data) to kilometers for legend
+            b = [round((x/1000),0) for x in brksBins]
+            brksBins = b
+            del b
+
+        brksCounts = self.counts[:-1] #Do not take into account NoData values
+
+        #Check if brksCounts and brksBins dismatches --> insert 0 values if necessary (to match the counts)
+        if len(brksBins) != len(brksCounts):
+            dif = len(brksBins)-len(brksCounts)
+            brksCounts = np.append(brksCounts,[0 for x in xrange(dif)])
+
+        #List for measures which will be inserted to class labels
+        measureList = [self.measure for x in xrange(len(brksBins))]
+
+        #Class labels
+        jenks_labels = ["%0.0f %s (%0.1f %%)" % (b, msr, (c/13230.0)*100) for b, msr, c in zip(brksBins[:-1],measureList[:-1],brksCounts[:-1])]
+
+        if self.Manual == True:
+            if "dist" in self.attribute:
+                jenks_labels.insert(int(self.maxBin), '>' + self.maxClassInfo +' km (%0.1f %%)' % ((brksCounts[-1]/13230.0)*100))
+            else:
+                jenks_labels.insert(int(self.maxBin), '>'+ self.maxClassInfo +' min (%0.1f %%)' % ((brksCounts[-1]/13230.0)*100))
+
+        jenks_labels.insert(self.NoData, 'NoData (%0.1f %%)' % (self.NullP))
+
+        return jenks_labels
+
+def classify(values, attribute, classification, Nclasses, classifier='fast', sample=None, shared=None):
+    """Classifies travel times/distances of one map (values in the order of the grid, NoData as NaN) and returns a Classification.
+    values can also be a 2D block with one row per map, a list of Classifications is then returned."""
+    values = np.asarray(values, dtype=float)
+
+    if values.ndim == 1:
+        result = Classification(values, attribute, classification, Nclasses, classifier, sample, shared)
+        if result.Manual:
+            result.setClasses(*binClasses(result.filled, result.classBins))
+        return result
+
+    result = [Classification(row, attribute, classification, Nclasses, classifier, sample, shared) for row in values]
+
+    #Maps that have the same bins (e.g. all maps whose values stay below the highest class) are classified together
+    groups = {}
+    for i, C in enumerate(result):
+        if C.Manual:
+            groups.setdefault(tuple(C.classBins), []).append(i)
+
+    for bins, rows in groups.items():
+        classes, counts = binClasses(np.vstack([result[i].filled for i in rows]), list(bins))
+        for j, i in enumerate(rows):
+            result[i].setClasses(classes[j], counts[j])
+
+    return result
+
+#---------------------------------------------
+#RENDER CACHE
+#---------------------------------------------
+
+#Version of the map drawing (change when the look of the maps changes, all cached maps are then drawn again)
+RENDER_VERSION = 2
+
+#Manifest of the render cache in the output folder (lines: <map file name>;<render key>)
+MANIFEST_NAME = "RenderManifest.txt"
+
+class RenderCache:
+    """Render keys of the maps in an output folder. A map whose file exists and whose key has not changed is not drawn again.
+    Keys of new maps are kept pending until the maps are on disk (commit), so the manifest never lists a map that was not written."""
+    def __init__(self, outputFolder, collect=False, shard=None):
+        """Constructor. With collect=True committed keys are only collected (worker processes return them to the parent process).
+        A shard (i, n) appends to its own manifest, so shards running on several machines never write to the same file."""
+        self.outputFolder = outputFolder
+        self.path = os.path.join(outputFolder, MANIFEST_NAME.replace(".txt", shardSuffix(shard) + ".txt"))
+        self.collect = collect
+        self.keys = self.load()
+        self.pending = []
+        self.committed = []
+
+    def load(self):
+        #Manifests of all shards are read (own manifest last), later lines replace the earlier ones
+        keys = {}
+        paths = glob.glob(os.path.join(self.outputFolder, MANIFEST_NAME.replace(".txt", "*.txt")))
+        for path in sorted(paths, key=lambda p: p == self.path):
+            with open(path) as f:
+                for line in f:
+                    parts = line.strip().split(';')
+                    if len(parts) == 2:
+                        keys[parts[0]] = parts[1]
+        return keys
+
+    def isCurrent(self, outputPath, key):
+        """True if the map file exists and it was drawn with the same key"""
+        fileName = os.path.basename(outputPath)
+        return self.keys.get(fileName) == key and os.path.isfile(outputPath)
+
+    def add(self, outputPath, key):
+        #Key of a map that is being written
+        self.pending.append((os.path.basename(outputPath), key))
+
+    def commit(self, failed=[], waiting=[]):
+        """Records the pending keys after their maps are written. Maps in failed are dropped, maps in waiting are still being written."""
+        failed = set(os.path.basename(f) for f in failed)
+        waiting = set(os.path.basename(f) for f in waiting)
+        entries = [(fileName, key) for fileName, key in self.pending if not fileName in failed and not fileName in waiting]
+        self.pending = [(fileName, key) for fileName, key in self.pending if fileName in waiting]
+        if self.collect:
+            self.committed.extend(entries)
+        else:
+            self.record(entries)
+
+    def record(self, entries):
+        #Append entries to the manifest
+        if len(entries) == 0:
+            return
+        with open(self.path, 'a') as f:
+            f.write("".join("%s;%s\n" % entry for entry in entries))
+        for fileName, key in entries:
+            self.keys[fileName] = key
+
+    def popCommitted(self):
+        #Return the collected entries and empty the buffer
+        entries = self.committed
+        self.committed = []
+        return entries
+
+def layersKey(Ykr, Coast, Roads, Metro, population):
+    """Hash of the geometries and population that are drawn to every map"""
+    h = hashlib.sha1()
+    for poly in chain(Ykr['poly'].values, Coast['poly'].values):
+        h.update(poly.wkb)
+    for layer in [Roads, Metro]:
+        h.update(layer.coords.tostring())
+        h.update(layer.offsets.tostring())
+    h.update(population.tostring())
+    return h.hexdigest()
+
+#---------------------------------------------
+#RUN JOURNAL
+#---------------------------------------------
+
+class RunJournal:
+    """Journal of a map run in the output folder. Each completed file is recorded (one line, flushed to disk) together with
+    its statistics rows. A restarted run skips the completed files and the statistics files are written from the journal
+    at the end, so they have no duplicate rows. The journal is started again if the run settings or inputs change, or if
+    the previous run was finished (see finish). A shard (i, n) has its own journal and writes its statistics to fragments (see mergeStatistics)."""
+    def __init__(self, outputFolder, attributes, settings, shard=None):
+        """Constructor, settings is a string that identifies the run (maps, classification and drawing settings and input signatures)"""
+        self.outputFolder = outputFolder
+        self.attributes = list(attributes)
+        self.settings = settings
+        self.shard = shard
+        self.path = os.path.join(outputFolder, "RunJournal_%s%s.txt" % ("_".join(self.attributes), shardSuffix(shard)))
+
+        #Recorded files: basename --> (completed, statistics rows as (attribute, row) pairs)
+        self.files = OrderedDict()
+
+        #Files waiting for their maps to be written
+        self.pending = []
+
+        self.load()
+        self.journal = open(self.path, 'a')
+        if os.path.getsize(self.path) == 0:
+            self.write({'settings': self.settings})
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+
+        with open(self.path, 'rb') as f:
+            lines = f.read().split('\n')
+
+        #Last line is incomplete if the run was killed while writing it --> cut it off
+        complete = '\n'.join(lines[:-1]) + '\n'
+        if lines[-1] != "":
+            with open(self.path, 'wb') as f:
+                f.write(complete.lstrip('\n'))
+
+        entries = [json.loads(line) for line in lines[:-1] if line != ""]
+        if len(entries) == 0 or entries[0].get('settings') != self.settings:
+            print "Run settings have changed, starting a new run journal (%s)" % os.path.basename(self.path)
+            os.remove(self.path)
+            return
+
+        #All files of the previous run were completed --> the run is done again from the beginning
+        if entries[-1].get('finished'):
+            print "Previous run was finished, starting a new run journal (%s)" % os.path.basename(self.path)
+            os.remove(self.path)
+            return
+
+        for entry in entries[1:]:
+            self.files[str(entry['file'])] = (entry['completed'], [(str(attribute), str(row)) for attribute, row in entry['rows']])
+
+    def write(self, entry):
+        #One line per entry, on disk before the next file is processed
+        self.journal.write(json.dumps(entry) + '\n')
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    def isCompleted(self, basename):
+        return basename in self.files and self.files[basename][0]
+
+    def remaining(self, files):
+        """Files that have not been completed yet"""
+        return [f for f in files if not self.isCompleted(os.path.basename(f)[:-4])]
+
+    def record(self, basename, rows, completed=True):
+        """Records a processed file. Failed files (completed=False) keep their statistics rows but are processed again on a restart."""
+        self.write({'file': basename, 'completed': completed, 'rows': rows})
+        if basename in self.files:
+            del self.files[basename]
+        self.files[basename] = (completed, rows)
+
+    def add(self, basename, rows, completed=True):
+        #File whose maps may still be written in the background (see commit)
+        self.pending.append((basename, rows, completed))
+
+    def commit(self, waiting=set(), failed=set()):
+        """Records the pending files whose maps are on disk (basenames in waiting are still being written, maps in failed were not written)"""
+        stillWaiting = []
+        for basename, rows, completed in self.pending:
+            if basename in waiting:
+                stillWaiting.append((basename, rows, completed))
+            else:
+                self.record(basename, rows, completed and not basename in failed)
+        self.pending = stillWaiting
+
+    def writeStatistics(self, binary=False):
+        """Writes the statistics files of the attributes from the journal (binary=True writes also the columnar copies)"""
+        for attribute in self.attributes:
+            rows = [row for completed, fileRows in self.files.values() for a, row in fileRows if a == attribute]
+            writeStatisticsTable(self.outputFolder, attribute, rows, self.shard)
+            if binary:
+                writeStatisticsBinary(self.outputFolder, attribute, self.shard)
+
+    def finish(self):
+        #Terminal entry: all files of the run are completed (the next run with the same journal starts from the beginning)
+        self.write({'finished': True})
+
+    def close(self):
+        self.journal.close()
+
+#---------------------------------------------
+#RUN REPORT
+#---------------------------------------------
+
+#Timed stages of the maps (see MapGenerator.stageTime): reading and joining the matrix, classification, statistics and
+#population curve, grid patches and static layers (only the 'figure' renderer builds them for every map), colour bar and texts,
+#histograms, and saving (drawing the figure to pixels and writing or queueing the image)
+STAGES = ['read', 'join', 'classify', 'statistics', 'patches', 'layers', 'draw', 'histograms', 'save']
+
+def residentMemory():
+    #Resident memory of the process in MB (None if it can not be read)
+    if psutil != None:
+        return psutil.Process(os.getpid()).memory_info().rss / 1048576.0
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1048576.0
+    except (IOError, ValueError, AttributeError):
+        return None
+
+class MemorySampler:
+    """Samples the resident memory of the process in a background thread. peak() returns the peak (MB) since the previous call."""
+    def __init__(self, interval=0.02):
+        """Constructor, interval is the time (s) between the samples"""
+        self.interval = interval
+        self.maximum = residentMemory()
+        self.stopped = False
+        self.thread = None
+        if self.maximum != None:
+            self.thread = threading.Thread(target=self.sample)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def sample(self):
+        while not self.stopped:
+            self.maximum = max(self.maximum, residentMemory())
+            time.sleep(self.interval)
+
+    def peak(self):
+        if self.thread == None:
+            return None
+        current = residentMemory()
+        peak = max(self.maximum, current)
+        self.maximum = current
+        return peak
+
+    def close(self):
+        self.stopped = True
+        if self.thread != None:
+            self.thread.join()
+
+class RunReport:
+    """Machine-readable report of a map run (RunReport_<attributes>.jsonl in the output folder). Each run appends a header line
+    and one line per file with the seconds spent in each stage (see STAGES) and the peak memory. summary() gives the
+    p50/p95 of the stages and the throughput of the run."""
+    def __init__(self, outputFolder, attributes, settings=None, shard=None):
+        """Constructor, settings is a dictionary of the run settings written to the header line"""
+        self.attributes = list(attributes)
+        self.path = os.path.join(outputFolder, "RunReport_%s%s.jsonl" % ("_".join(self.attributes), shardSuffix(shard)))
+        self.start = time.time()
+        self.entries = []
+        self.report = open(self.path, 'a')
+        self.write({'run': time.strftime("%Y-%m-%d %H:%M:%S"), 'attributes': self.attributes, 'settings': settings})
+
+    def write(self, entry):
+        self.report.write(json.dumps(entry) + '\n')
+        self.report.flush()
+
+    def record(self, basename, maps, timings, error=None):
+        """Records a processed file. timings is {'stages': {stage: seconds}, 'peakMB': MB} (see MapGenerator.popTimings),
+        error is the exception of a failed file (as text)."""
+        entry = {'file': basename, 'maps': maps, 'error': error}
+        entry.update(timings)
+        self.entries.append(entry)
+        self.write(entry)
+
+    def summary(self):
+        """Summary of the recorded files as text lines (and a 'summary' line to the report)"""
+        elapsed = time.time()-self.start
+        maps = sum(entry['maps'] for entry in self.entries)
+        summary = {'files': len(self.entries), 'maps': maps, 'seconds': elapsed, 'mapsPerSecond': maps/max(elapsed, 1e-6), 'stages': {}}
+
+        lines = ["%-12s %10s %10s %10s" % ("Stage", "p50 (ms)", "p95 (ms)", "total (s)")]
+        for stage in STAGES:
+            seconds = [entry['stages'][stage] for entry in self.entries if stage in entry['stages']]
+            if len(seconds) == 0:
+                continue
+            p50, p95 = np.percentile(seconds, [50, 95])
+            summary['stages'][stage] = {'p50': p50, 'p95': p95, 'total': sum(seconds)}
+            lines.append("%-12s %10.1f %10.1f %10.1f" % (stage, p50*1000, p95*1000, sum(seconds)))
+
+        peaks = [entry['peakMB'] for entry in self.entries if entry.get('peakMB') != None]
+        summary['peakMB'] = max(peaks) if len(peaks) > 0 else None
+        text = "%d maps from %d files in %0.0f s (%0.2f maps/s)" % (maps, len(self.entries), elapsed, summary['mapsPerSecond'])
+        if summary['peakMB'] != None:
+            text += ", peak memory %0.0f MB" % summary['peakMB']
+
+        #Memory after the first and the last file (grows if something is not released between the maps)
+        rss = [entry['rssMB'] for entry in self.entries if entry.get('rssMB') != None]
+        if len(rss) > 1:
+            summary['rssGrowthMB'] = rss[-1]-rss[0]
+            text += ", memory after the maps %0.0f --> %0.0f MB" % (rss[0], rss[-1])
+        lines.append(text)
+
+        self.write({'summary': summary})
+        return lines
+
+    def close(self):
+        self.report.close()
+
 class MapGenerator:
     """Generates the maps with chosen parameters and saves them to disk"""
-    def __init__(self, MapInstance , Ykr, Ykr_pop, Coast, Roads, Metro, outputFolder, attribute, classification, coords, numberOfClasses):
+    def __init__(self, MapInstance , Ykr, Ykr_pop, Coast, Roads, Metro, outputFolder, attribute, classification, coords, numberOfClasses, collectStatistics=False, renderer='template', staticBackground=False, dpi=300, matrixStore=None, gridIndex=None, imageFormat='png', compression=6, quality=90, writerThreads=0, mapList=None, renderCache=False, binaryStatistics=False, shard=None, timeStages=False, memoryLimit=None, classifier='fast', classifierSample=None, classBreaks=None):
         self.B = MapInstance
         self.outputFolder = outputFolder
         self.Y = Ykr
@@ -149,9 +1251,83 @@ class MapGenerator:
         self.Cl = classification
         self.Nclasses = numberOfClasses
         self.basename = ""
-        self.statistics = self.createStatistics()
+
+        #Attribute/classification pairs of the maps drawn from each matrix (each file is read and joined only once for all of them)
+        if mapList == None:
+            mapList = [(attribute, classification)]
+        self.mapList = [tuple(pair) for pair in mapList]
+        self.attributes = [pair[0] for pair in self.mapList]
+        if len(set(self.attributes)) != len(self.attributes):
+            raise ValueError("Each attribute can be mapped only once in a run (maps and statistics are named by the attribute)")
+        self.A, self.Cl = self.mapList[0]
         self.coords = coords
 
+        #Shard (i, n) of a run split over several machines (statistics and render manifest are written to the files of the shard)
+        self.shard = shard
+
+        #YKR_ID --> grid row lookup (see MapInstance.getGridIndex)
+        if gridIndex == None:
+            gridIndex = GridIndex(self.Y['YKR_ID'].values, self.Y['poly'].values)
+        self.index = gridIndex
+
+        #Population of the grid cells (in the order of the grid) is read only once
+        self.population = self.loadPopulation()
+
+        #'template' reuses one figure for all maps (see MapTemplate), 'raster' is the same with the grid drawn as an image,
+        #'figure' draws a new figure for every map
+        self.renderer = renderer
+        self.template = None
+
+        #Draw coastline, roads and metro to a cached image instead of vector layers (only with the 'template' renderer)
+        self.staticBackground = staticBackground
+
+        #Resolution of the output maps
+        self.dpi = dpi
+
+        #Writes the maps of the 'template' and 'raster' renderers (format, compression and background threads, see MetropAccess_MapGenerator_writer)
+        self.writer = MGW.ImageWriter(imageFormat, compression, quality, writerThreads)
+
+        #Skip maps that exist in the output folder and whose data and settings have not changed (see RenderCache)
+        self.cache = None
+        if renderCache:
+            self.cache = RenderCache(outputFolder, collect=collectStatistics, shard=shard)
+            self.settingsKey = repr((RENDER_VERSION, renderer, staticBackground, dpi, imageFormat, compression, quality, numberOfClasses,
+                                     layersKey(self.Y, self.C, self.R, self.M, self.population)))
+
+        #Folder of a matrix store (see MetropAccess_MapGenerator_store), matrices are then read from it instead of the text files
+        self.store = None
+        if matrixStore != None:
+            self.store = MGS.MatrixStore(matrixStore)
+
+        #Worker processes do not write the statistics file themselves, rows are collected and returned to the parent process
+        self.collectStatistics = collectStatistics
+        self.statRows = []
+        self.binaryStatistics = binaryStatistics
+        self.statistics = None
+        if not self.collectStatistics:
+            self.statistics = self.createStatistics()
+
+        #Seconds spent in each stage of the files (basename --> {stage: seconds}) and peak memory, see popTimings and RunReport
+        self.timings = None
+        self.memory = None
+        if timeStages:
+            self.timings = {}
+            self.memory = MemorySampler()
+
+        #Growth of the process memory (MB) since the first map that is allowed before matplotlib state is released (see checkMemory)
+        self.memoryLimit = memoryLimit
+        self.memoryBaseline = None
+
+        #Engine of Natural Breaks, Quantiles and Fisher's Jenks ('fast' or 'pysal') and the sample size of the 'fast' engine
+        self.classifier = classifier
+        self.classifierSample = classifierSample
+
+        #Class breaks shared by all maps of the run ({(attribute, classification): bins}, see sharedBreaks), other maps are classified one by one
+        self.classBreaks = classBreaks or {}
+
+        #Colour maps of the classes are made once for each number of classes (see my_colormap)
+        self.colormaps = {}
+
 
     #Convenience functions for working with colour ramps and bars
     def colorbar_index(self,ncolors, cmap, labels=None, **kwargs):
@@ -175,14 +1351,19 @@ class MapGenerator:
 
     def my_colormap(self,cmap, N):
 
+        #Same colour map is used for all maps with the same number of classes
+        cacheKey = (cmap.name, N)
+        if cacheKey in self.colormaps:
+            return self.colormaps[cacheKey]
+
         #Adapted from: http://stackoverflow.com/questions/19199359/modify-discrete-linearsegmentedcolormap
         colors_i = np.concatenate((np.linspace(0, 1., N), (0.,0.,0.,0.)))
         colors_rgba = cmap(colors_i)
         indices = np.linspace(0, 1., N+1)
 
         cdict = {}
-        for ki,key in enumerate(('red','green','blue')):
-            cdict[key] = [ (indices[i], colors_rgba[i-1,ki], colors_rgba[i,ki]) for i in xrange(N+1) ]
+        for ki,channel in enumerate(('red','green','blue')):
+            cdict[channel] = [ (indices[i], colors_rgba[i-1,ki], colors_rgba[i,ki]) for i in xrange(N+1) ]
 
         # "white out" the bands closest to the upper end
         num_end_bands = 1 #Number of classes from the end to white out
@@ -191,43 +1372,116 @@ class MapGenerator:
         #"White out" the NoData band
         for end_band_idx in range(end_band_start_idx,
                                      end_band_start_idx + num_end_bands):
-            for key in cdict.keys():
-                old = cdict[key][end_band_idx]
-                cdict[key][end_band_idx] = old[:2] + (1.,)
-                old = cdict[key][end_band_idx + 1]
-                cdict[key][end_band_idx + 1] = old[:1] + (1.,) + old[2:]
+            for channel in cdict.keys():
+                old = cdict[channel][end_band_idx]
+                cdict[channel][end_band_idx] = old[:2] + (1.,)
+                old = cdict[channel][end_band_idx + 1]
+                cdict[channel][end_band_idx + 1] = old[:1] + (1.,) + old[2:]
         
         #Return colormap object.
-        return LinearSegmentedColormap(cmap.name + "_%d"%N, cdict, 1024)
+        self.colormaps[cacheKey] = LinearSegmentedColormap(cmap.name + "_%d"%N, cdict, 1024)
+        return self.colormaps[cacheKey]
 
     def reclassify(self, key, value):
         return key[value]
 
     def createStatistics(self):
-        output = self.outputFolder
-
-        #Create outputfile for travel time statistics
-        MeanName = "MeanTravelTimes_" + self.A + ".csv"
-        meanTimes = os.path.join(output, MeanName)
+        #Statistics files are opened once for the run (see StatisticsSink)
+        if self.statistics == None:
+            self.statistics = StatisticsSink(self.outputFolder, self.attributes, binary=self.binaryStatistics, shard=self.shard)
+        return self.statistics
 
-        if os.path.isfile(meanTimes):
-            exists = True
+    def writeStatistics(self, data, attribute=None):
+        if attribute == None:
+            attribute = self.A
+        if self.collectStatistics:
+            self.statRows.append((attribute, data))
         else:
-            exists = False
-
-        self.statistics = open(meanTimes, 'a')
+            self.statistics.write(attribute, data)
 
-        #Write header if file does not exist already
-        if exists == False:
-            self.statistics.write("YKR_ID;mean;median;std;min;max\n")
-
-        return self.statistics
-
-    def writeStatistics(self,data):
-        self.statistics.write(data)
+    def popStatistics(self):
+        #Return the collected (attribute, statistics row) pairs and empty the buffer
+        rows = self.statRows
+        self.statRows = []
+        return rows
 
     def closeStatistics(self):
-        self.statistics.close()
+        if self.statistics != None:
+            self.statistics.close()
+            self.statistics = None
+
+    def stageTime(self, basename, stage, start):
+        """Adds the time since start to a stage of a file (if the stages are timed). Returns the current time (start of the next stage)."""
+        now = time.time()
+        if self.timings != None:
+            times = self.timings.setdefault(basename, {})
+            times[stage] = times.get(stage, 0.0) + now-start
+        return now
+
+    def popTimings(self, basename):
+        #Stage times of a file and the peak memory since the previous file (None if the stages are not timed)
+        if self.timings == None:
+            return None
+        return {'stages': self.timings.pop(basename, {}), 'peakMB': self.memory.peak(), 'rssMB': residentMemory()}
+
+    def closeTimings(self):
+        if self.memory != None:
+            self.memory.close()
+            self.memory = None
+
+    def checkMemory(self):
+        """Releases matplotlib state (see releaseMemory) if the process memory has grown more than memoryLimit (MB) since the first map"""
+        if self.memoryLimit == None:
+            return
+        rss = residentMemory()
+        if rss == None:
+            return
+        if self.memoryBaseline == None:
+            self.memoryBaseline = rss
+            return
+
+        if rss-self.memoryBaseline > self.memoryLimit:
+            self.releaseMemory()
+            released = residentMemory()
+            print "Memory grew %0.0f MB since the first map, released matplotlib state (%0.0f --> %0.0f MB)" % (rss-self.memoryBaseline, rss, released)
+
+            #Memory that is not returned (e.g. fragmentation) does not cause a release after every map
+            if released-self.memoryBaseline > self.memoryLimit:
+                self.memoryBaseline = released
+
+    def releaseMemory(self):
+        #Close all figures (template is created again for the next map) and collect the garbage (images being written are not affected)
+        if self.template != None:
+            self.template.close()
+            self.template = None
+        plt.close('all')
+        gc.collect()
+
+    def flushImages(self):
+        """Waits until the maps are written to disk, returns the errors of the background writes"""
+        errors = self.writer.flush()
+        if self.cache != None:
+            self.cache.commit([outputPath for outputPath, e in errors])
+        return errors
+
+    def closeWriter(self):
+        #Stop the background writer threads at the end of the run (the maps are flushed first)
+        self.writer.close()
+
+    def outputBasename(self, outputPath):
+        #Basename of the matrix file of a map file (<basename><attribute>.<extension>)
+        name = os.path.splitext(os.path.basename(outputPath))[0]
+        for attribute in self.attributes:
+            if name.endswith(attribute):
+                return name[:-len(attribute)]
+        return name
+
+    def unfinishedFiles(self):
+        """Basenames of the files whose maps are still being written and of the files whose maps failed to be written"""
+        self.writer.poll()
+        waiting = set(self.outputBasename(outputPath) for outputPath in self.writer.pendingPaths())
+        failed = set(self.outputBasename(error[0]) for error in self.writer.errors)
+        return waiting, failed
 
     def returnOutPath(self):
         return self.outPath
@@ -242,494 +1496,983 @@ class MapGenerator:
         start = time.time()
 
         #Create file which hold statistics for each inputFile (containing mean/median travel times, std, min, max etc.)
-        self.statistics = self.createStatistics()
+        if not self.collectStatistics:
+            self.createStatistics()
         self.basename = os.path.basename(inputFile)[:-4]
-        AttributeParameter = self.A
-        coords = self.coords
-
-        #Format figure
-        plt.clf()
-        fig = plt.figure()
-
-        #Picture frame for Map
-        gs = gridspec.GridSpec(12, 12)
-        ax = plt.subplot(gs[:,:],axisbg='w', frame_on=False)
 
         try:
-            #Read MetropAccess-matka-aikamatriisi data in
-            MatrixData = pd.read_csv(inputFile, sep=';')
+            #Read, join and classify the data (once for all the maps of the file)
+            maps = self.prepareMaps(inputFile, self.readMatrix(inputFile))
 
-            #Join data to shapefile (pandas 'merge' function)
-            df_map = pd.merge(left=self.Y, right=MatrixData, how='outer', left_on='YKR_ID', right_on='from_id')
+            #Write statistics and draw the maps
+            exception = self.saveMaps(maps)
+            if exception != None:
+                return exception
 
-            #CLASSIFY MATRIX DATA
-            #Replace -1 values
-            df_map.replace(to_replace={AttributeParameter: {-1: np.nan}}, inplace=True)
+            end = time.time()
+            lasted = int(end-start)
+            return lasted
 
-            #Data for histogram
-            histData = pd.DataFrame(df_map[df_map[AttributeParameter].notnull()][AttributeParameter].values)
+        except Exception as e:
+            return e
+
+    def saveMaps(self, maps):
+        """Saves the prepared maps of a file (see prepareMaps). Maps that failed are skipped, the first exception is returned."""
+        exception = None
+        for mapData in maps:
+            try:
+                if isinstance(mapData, Exception):
+                    raise mapData
+                self.saveMap(mapData)
+            except Exception as e:
+                if exception == None:
+                    exception = e
+
+        #Keys of the maps that are on disk already go to the manifest
+        if self.cache != None:
+            self.writer.poll()
+            self.cache.commit([error[0] for error in self.writer.errors], self.writer.pendingPaths())
+
+        self.checkMemory()
+        return exception
+
+    def saveMap(self, mapData):
+        """Writes the statistics row of a prepared map (see prepareMap) and draws the map to disk"""
+
+        #Write information to a statistics file
+        self.writeStatistics(mapData['statistics'], mapData['attribute'])
+
+        outputPath = os.path.join(self.outputFolder, mapData['basename']) + mapData['attribute']
+        if self.renderer in ['template', 'raster']:
+            outputPath += self.writer.extension
+        else:
+            outputPath += ".png"
 
-            maxBin = max(df_map[df_map[AttributeParameter].notnull()][AttributeParameter].values) #.AttributeParameter.values)
-            NoData = int(maxBin+1)
-            NullCount = len(df_map[df_map[AttributeParameter].isnull()])
-            NullP = (NullCount/13230.0)*100
+        #Map is on disk already with the same data and settings
+        if self.cache != None:
+            if self.cache.isCurrent(outputPath, mapData['renderKey']):
+                return
+            self.cache.add(outputPath, mapData['renderKey'])
 
-            #Fill NoData values with maxBin+1 value
-            df_map[AttributeParameter].fillna(NoData, inplace=True)
+        #Draw the map and save it to disk
+        if self.renderer in ['template', 'raster']:
+            self.getTemplate().render(mapData, outputPath)
+        else:
+            self.drawMap(mapData, outputPath)
 
-            #Manual classification
-            if not self.Cl in ['Natural Breaks', 'Quantiles', "Fisher's Jenks"]:
-                #Create bins for classification based on chosen classification method
-                Manual = True
+    def readMatrix(self, inputFile):
+        #Read MetropAccess-matka-aikamatriisi data in (from the matrix store if there is one, file name tells the destination)
+        start = time.time()
+        if self.store != None:
+            MatrixData = self.store.readMatrix(MGS.destinationId(inputFile), self.attributes)
+        else:
+            MatrixData = pd.read_csv(inputFile, sep=';')
+        self.stageTime(os.path.basename(inputFile)[:-4], 'read', start)
+        return MatrixData
+
+    def getTemplate(self):
+        #Figure template is created at the first map and reused for all the following maps
+        if self.template == None:
+            self.template = MapTemplate(self)
+        return self.template
+
+    def loadPopulation(self):
+        """Reads the YKR population file and returns the population of the grid cells in the order of the grid (cells without population are 0)"""
+        pop = pd.read_csv(self.Ypop, sep=';')
+        population = self.index.align(pop['YKR_ID'].values, pop['Population'].values)
+        population[np.isnan(population)] = 0
+        return population
+
+    def cumulativePopulation(self, values):
+        """Cumulative population reached within x minutes/meters. values are the travel times/distances in the order of the grid (NoData as NaN).
+        Returns a Series indexed by the travel time/distance values."""
+        valid = ~np.isnan(values)
+        steps = values[valid].astype(np.int64)
+
+        #Population of each travel time/distance value and cumulative sum over them
+        #(population is counted in persons --> integers like in the population file)
+        cumPop = np.cumsum(np.bincount(steps, weights=self.population[valid])).round().astype(np.int64)
+
+        reached = np.unique(steps)
+        return pd.Series(cumPop[reached], index=reached.astype(float))
+
+    def prepareMaps(self, inputFile, MatrixData):
+        """Prepares the maps of all attribute/classification pairs from one matrix. Maps that fail are returned as exceptions."""
+        maps = []
+        for attribute, classification in self.mapList:
+            try:
+                maps.append(self.prepareMap(inputFile, MatrixData, attribute, classification))
+            except Exception as e:
+                maps.append(e)
+        return maps
+
+    def prepareMap(self, inputFile, MatrixData, attribute=None, classification=None):
+        """Joins the travel time matrix (see readMatrix) to the grid and classifies it. Returns everything needed for drawing the map as a dictionary."""
+
+        if attribute == None:
+            attribute, classification = self.A, self.Cl
+        AttributeParameter = attribute
+        basename = os.path.basename(inputFile)[:-4]
+        start = time.time()
 
-                if "time" in AttributeParameter:
-                    measure = "min"
-                    measure2 = "minutes" #Another string-form for summary
-                    titleMeas = "time"
+        #Join data to the grid (values in the order of the grid, origins outside the grid are left out)
+        values = MatrixData[AttributeParameter].values.astype(float)
+
+        #Replace -1 values
+        values[values == -1] = np.nan
+        values = self.index.align(MatrixData['from_id'].values, values)
+
+        #Data for histogram
+        histData = pd.DataFrame(values[~np.isnan(values)])
+
+        #Key of the map in the render cache (data of the map, destination, classification and drawing settings)
+        renderKey = None
+        if self.cache != None:
+            classificationKey = classification
+            if classification in DATA_DRIVEN:
+                classificationKey = (classification, self.classifier, self.classifierSample, self.classBreaks.get((attribute, classification)))
+            renderKey = hashlib.sha1(values.tostring() + repr((basename, attribute, classificationKey, self.settingsKey))).hexdigest()
+        start = self.stageTime(basename, 'join', start)
+
+        #CLASSIFY MATRIX DATA
+        classified = classify(values, AttributeParameter, classification, self.Nclasses, self.classifier, self.classifierSample,
+                              self.classBreaks.get((attribute, classification)))
+        measure2 = classified.measure2
+        titleMeas = classified.titleMeas
+
+        #Use modified colormap ('my_colormap') - Choose here the default colormap which is used as a startpoint --> cm.YourColor'sName (eg. cm.Blues) - See available Colormaps: http://matplotlib.org/examples/color/colormaps_reference.html
+        cmap = self.my_colormap(cm.RdYlBu, len(classified.bins))
+
+        #Colours of the grid cells
+        gridColors = cmap(classified.colorValues)
+        start = self.stageTime(basename, 'classify', start)
+
+        #----------------------
+        #TARGET POINT
+        #----------------------
+        #Generate YKR_ID from csv name
+        ykrID = int(basename.split('_')[2])
+
+        #Centroid of the target cell
+        tRow = self.index.row(ykrID)
+        if tRow < 0:
+            raise ValueError("Destination %s is not in the YKR grid" % ykrID)
+        centroid = self.index.centroids[tRow]
+
+        #Set up title
+        if "PT" in AttributeParameter:
+            tMode = "public transportation"
+        elif "Car" in AttributeParameter:
+            tMode = "car"
+        elif "Walk" in AttributeParameter:
+            tMode = "walking"
+
+        titleText = "Travel %s to %s (YKR-ID) \n by %s" % (titleMeas,str(ykrID),tMode)
+
+        #Inform travel sum of the whole grid (i.e. centrality of the location)
+        #Travel time
+        if measure2 == "minutes":
+            tMean = histData.mean().values[0]
+            tMedian=histData.median().values[0]
+            tMax = histData.max().values[0]
+            tMin = histData.min().values[0]
+            tStd=histData.std().values[0]
+            travelSummary = "Summary:"
+            travelMean = "Mean: %0.0f %s" % (tMean, measure2)
+            travelMedian = "Median: %0.0f %s" % (tMedian, measure2)
+            travelStd = "Std: %0.0f %s" % (tStd,measure2)
+            travelRange = "Range: %0.0f-%0.0f %s" % (tMin,tMax,measure2)
+
+        #Travel distance
+        else:
+            h = histData.values/1000
+            histData = pd.DataFrame(h)
+            del h
+            tMean = histData.mean().values[0]
+            tMedian=histData.median().values[0]
+            tMax = histData.max().values[0]
+            tMin = histData.min().values[0]
+            tStd=histData.std().values[0]
+            travelSummary = "Summary:"
+            travelMean = "Mean: %0.1f %s" % (tMean, measure2)
+            travelMedian = "Median: %0.1f %s" % (tMedian, measure2)
+            travelStd = "Std: %0.1f %s" % (tStd,measure2)
+            travelRange = "Range: %0.1f-%0.1f %s" % (tMin,tMax,measure2)
+
+        #Statistics row of the map
+        mInfo = "%s;%0.0f;%0.0f;%0.0f;%0.0f;%0.0f\n" % ( str(ykrID), tMean, tMedian, tStd, tMin, tMax)
+
+        #----------------------------------------------------
+        #Cumulative population reached within x minutes/km
+
+        cumPop = self.cumulativePopulation(values)
+
+        #Distances in kilometers like in the histogram
+        if measure2 != "minutes":
+            cumPop.index = cumPop.index/1000
+        self.stageTime(basename, 'statistics', start)
+
+        return {'basename': basename,
+                'attribute': attribute,
+                'renderKey': renderKey,
+                'gridColors': gridColors,
+                'cmap': cmap,
+                'labels': classified.labels,
+                'ykrID': ykrID,
+                'centroid': (centroid[0], centroid[1]),
+                'title': titleText,
+                'titleMeas': titleMeas,
+                'measure2': measure2,
+                'summary': (travelSummary, travelMean, travelMedian, travelStd, travelRange),
+                'histData': histData,
+                'cumPop': cumPop,
+                'statistics': mInfo}
+
+    #-----------------------------
+    #DRAWING HELPERS
+    #-----------------------------
+
+    def drawMapscale(self, ax):
+        #Draw a map scale
+        coords = self.coords
+        return self.B.drawmapscale(
+            coords[0] + 0.47, coords[1] + 0.013, #Etisyys vasemmalta, etisyys alhaalta: plussataan koordinaatteihin asteissa
+            coords[0], coords[1],
+            #10.,
+            10.,
+            barstyle='fancy', labelstyle='simple',yoffset=200, #yoffset determines the height of the mapscale
+            fillcolor1='w', fillcolor2='#909090', fontsize=6,  # black= #000000
+            fontcolor='#202020',
+            zorder=5, ax=ax)
+
+    def drawStaticLayers(self, ax):
+        #Layers that are the same in every map
+        from descartes import PolygonPatch
+
+        #Add coastline to the map
+        coastPatches = self.C['poly'].map(lambda x: PolygonPatch(x, fc='#606060', ec='#555555', lw=.25, alpha=.88, zorder=4)) #Alpha adjusts transparency, fc='facecolor', ec='edgecolor'
+        ax.add_collection(PatchCollection(coastPatches, match_original=True))
+
+        #Add roads to the map (roads and metro are ShapeArrays --> one LineCollection per layer)
+        ax.add_collection(LineCollection(self.R.parts(), linestyle='solid', colors='#606060', linewidths=0.7, alpha=.6, zorder=2))
+
+        #Add metro to the map
+        ax.add_collection(LineCollection(self.M.parts(), colors='#FF2F2F', linewidths=0.65, alpha=.4, zorder=2))
+
+        self.B.set_axes_limits(ax=ax)
+
+    def drawSummary(self, summary):
+        #Helper variables for moving Summary statistic texts
+        initialPos = .58 #.15  #.44
+        initialXPos = .975 #.20 #.97
+        textSize = 5.25
+        split = 0.018
+
+        travelSummary, travelMean, travelMedian, travelStd, travelRange = summary
+
+        #Plot Travel Summary title
+        tSummary = plt.figtext(initialXPos, initialPos+split*4,
+                   travelSummary, ha='left', va='bottom', color='#404040', size=textSize, style='normal',fontweight='bold')
+
+        #Plot Travel Summary mean
+        tMean = plt.figtext(initialXPos, initialPos+split*3,
+                   travelMean,ha='left', va='bottom', size=textSize, color='b')
+
+        #Plot Travel Summary median
+        tMedian = plt.figtext(initialXPos, initialPos+split*2,
+                   travelMedian,ha='left', va='bottom', size=textSize, color='r')
+
+        #Plot Travel Summary Standard deviation
+        tStd = plt.figtext(initialXPos, initialPos+split,
+                   travelStd,ha='left', va='bottom', size=textSize)
+
+        #Plot Travel Summary Range
+        tRange = plt.figtext(initialXPos, initialPos,
+                   travelRange,ha='left', va='bottom', size=textSize)
+
+        return tSummary, tMean, tMedian, tStd, tRange
+
+    def drawHistogram(self, ax, histData, measure2):
+        #Add travel time/distance histogram to the axes
+
+        #Add histogram
+        n, bins, patches = ax.hist(histData.values, 100, normed=False, facecolor='green', alpha=0.75, rwidth=0.5, orientation="vertical")
+        ax.axvline(histData.median(), color='r', linestyle='solid', linewidth=1.8)
+        ax.axvline(histData.mean(), color='b', linestyle='solid', linewidth=1.0)
+
+        if measure2 == "minutes":
+            ax.set_xlabel("t(min)", fontsize=5,labelpad=1.5)
+            xupLim = 250 #upper limit for x-axis
+        else:
+            ax.set_xlabel("km", fontsize=5,labelpad=1.5)
+            xupLim = 100 #upper limit for x-axis
 
-                    if self.Cl == "10 Minute Equal Intervals":
+        #Set valuelimits for axes
+        ax.set_xlim(0,xupLim-30)
 
-                        #Calculate the highest class (10 minutes * Number of classes)
-                        maxClass = 10*self.Nclasses
+        if max(n) < 1000: #ymax will be set to 1000 if count of individual bin is under 1000, else 1500
+            yMax = 1000
+        else:
+            yMax = 1600
 
-                        #Create 'higher than' info for the colorbar
-                        maxClassInfo = str(maxClass-10)
+        ax.set_ylim(0,yMax)
 
-                        #Create array of bins from 0 to highest class with increments of 10
-                        bins = np.arange(10, maxClass, 10)
+        #Adjust tick font sizes and set yaxis to right
+        ax.tick_params(axis='both', direction="out",labelsize=4.5, pad=1,
+                       labelright=True,labelleft=False, top=False, left=False,
+                       color='k', length=3, width=.9)
 
-                        #Add extra classes for No Data and higher than maxClass values
-                        if maxBin < maxClass:
-                            bins = list(np.append(bins, [maxClass+1, maxClass+2]))
-                        else:
-                            bins = list(np.append(bins, [maxBin, maxBin+1]))
+        ax.xaxis.set_ticks(np.arange(0,xupLim-30,30))
 
-                    elif self.Cl == "5 Minute Equal Intervals":
+        gridlines = ax.get_xgridlines()
+        gridlines.extend( ax.get_ygridlines() )
 
-                        #Calculate the highest class (10 minutes * Number of classes)
-                        maxClass = 5*self.Nclasses
+        for line in gridlines:
+            line.set_linewidth(.28)
+            line.set_linestyle('dotted')
 
-                        #Create 'higher than' info for the colorbar
-                        maxClassInfo = str(maxClass-5)
+        ax.grid(True)
 
-                        #Create array of bins from 0 to highest class with increments of 5
-                        bins = np.arange(5, maxClass, 5)
+    def drawPopulation(self, ax, cumPop, measure2):
+        #Add cumulative population curve to the axes
 
-                        #Add extra classes for No Data and higher than maxClass values
-                        if maxBin < maxClass:
-                            bins = list(np.append(bins, [maxClass+1, maxClass+2]))
-                        else:
-                            bins = list(np.append(bins, [maxBin, maxBin+1]))
+        if measure2 == "minutes":
+            xupLim = 250 #upper limit for x-axis
+        else:
+            xupLim = 100 #upper limit for x-axis
 
-                elif "dist" in AttributeParameter:
+        #Create filled curve plot from the cumulative population
+        ax.fill_between(cumPop.index,cumPop/1000,0, interpolate=True, lw=1, facecolor='green', alpha=0.6)
 
-                    measure = "km"
-                    measure2 = "kilometers"
-                    titleMeas = "distance"
+        #Set valuelimits for axes
+        ax.set_xlim(0,xupLim-50)
+        ax.set_ylim(-10,cumPop.max()/1000+50)
 
-                    if self.Cl == "5 Km Equal Intervals":
 
-                        #Calculate the highest class (5000 meters * Number of classes)
-                        maxClass = 5000*self.Nclasses
+        gridlines = ax.get_xgridlines()
+        gridlines.extend( ax.get_ygridlines() )
 
-                        #Create 'higher than' info for the colorbar
-                        maxClassInfo = str((maxClass-5000)/1000)
+        for line in gridlines:
+            line.set_linewidth(.28)
+            line.set_linestyle('dotted')
 
-                        #Create array of bins from 0 to highest class with increments of 5000 (meters)
-                        bins = np.arange(5000, maxClass, 5000)
+        ax.grid(True)
+        ax.tick_params(axis='both', direction="out",labelsize=4.5, pad=1,
+                                    labelright=True,labelleft=False, top=False, left=False,
+                                    color='k', length=3, width=.9)
+        ax.xaxis.set_ticks(np.arange(0,xupLim-30,30))
 
-                        #Add extra classes for No Data and higher than maxClass values
-                        if maxBin < maxClass:
-                            bins = list(np.append(bins, [maxClass+1, maxClass+2]))
-                        else:
-                            bins = list(np.append(bins, [maxBin, maxBin+1]))
+        if measure2 == "minutes":
+            ax.set_xlabel("t(min)", fontsize=5,labelpad=1.5)
+        else:
+            ax.set_xlabel("km", fontsize=5,labelpad=1.5)
 
-                    elif self.Cl == "10 Km Equal Intervals":
+    def populationTitle(self, measure2):
+        if measure2 == "minutes":
+            measure3 = 'minutes'
+        else:
+            measure3 = 'km'
+        return "Population (per 1000) reached within (x) %s" % measure3
 
-                        #Calculate the highest class (5000 meters * Number of classes)
-                        maxClass = 10000*self.Nclasses
+    #-----------------------------
+    #DRAW A NEW FIGURE FOR EACH MAP
+    #-----------------------------
 
-                        #Create 'higher than' info for the colorbar
-                        maxClassInfo = str((maxClass-10000)/1000)
+    def drawMap(self, mapData, outputPath):
+        """Draws the map on a new figure and saves it to disk"""
+        from descartes import PolygonPatch
 
-                        #Create array of bins from 0 to highest class with increments of 5000 (meters)
-                        bins = np.arange(0, maxClass, 10000)
+        basename = mapData['basename']
+        start = time.time()
 
-                        #Add extra classes for No Data and higher than maxClass values
-                        if maxBin < maxClass:
-                            bins = list(np.append(bins, [maxClass+1, maxClass+2]))
-                        else:
-                            bins = list(np.append(bins, [maxBin, maxBin+1]))
+        #Format figure (a new figure for every map, closed when the map is saved)
+        fig = plt.figure()
 
-                #Classify data based on bins
-                breaks = mc.User_Defined(df_map[df_map[AttributeParameter].notnull()][AttributeParameter], bins)
+        #Picture frame for Map
+        gs = gridspec.GridSpec(12, 12)
+        ax = plt.subplot(gs[:,:],axisbg='w', frame_on=False)
 
-            else:
-                Manual = False
-
-                if self.Cl == 'Natural Breaks':
-                    breaks = nb(df_map[df_map[AttributeParameter].notnull()][AttributeParameter],initial=100, k=self.Nclasses)
-                elif self.Cl == 'Quantiles':
-                    breaks = Quantiles(df_map[df_map[AttributeParameter].notnull()][AttributeParameter], k=self.Nclasses)
-                elif self.Cl == "Fisher's Jenks":
-                    breaks = fj(df_map[df_map[AttributeParameter].notnull()][AttributeParameter], k=self.Nclasses)
-
-                bins = list(breaks.bins)
-
-                if "time" in AttributeParameter:
-                    measure = "min"
-                    measure2 = "minutes" #Another string-form for summary
-                    titleMeas = "time"
-                    maxClassInfo = str(bins[-2])
-                else:
-                    measure = "km"
-                    measure2 = "kilometers"
-                    titleMeas = "distance"
-                    maxClassInfo = str(bins[-2]/1000)
+        #Draw grid with grey outlines
+        gridPatches = self.Y['poly'].map(lambda x: PolygonPatch(x, ec='#555555', lw=.2, alpha=1., zorder=4)) #RGB color-codes can be found at http://www.rapidtables.com/web/color/RGB_Color.htm
+        pc = PatchCollection(gridPatches, match_original=True)
 
-                bins.append(maxBin)
-                bins.append(maxBin)
+        #Impose colour map onto the patch collection
+        pc.set_facecolor(mapData['gridColors'])
 
+        #Add colored Grid to map
+        ax.add_collection(pc)
+        start = self.stageTime(basename, 'patches', start)
 
-            #the notnull method lets us match indices when joining
-            jb = pd.DataFrame({'jenks_bins': breaks.yb}, index=df_map[df_map[AttributeParameter].notnull()].index)
-            df_map = df_map.join(jb)
+        #Add coastline, roads and metro to the map
+        self.drawStaticLayers(ax)
+        start = self.stageTime(basename, 'layers', start)
 
-            brksBins = bins[:-1]#breaks.bins[:-1] #Do not take into account NoData values
+        #Generate target point
+        self.B.plot(
+            mapData['centroid'][0],mapData['centroid'][1],
+            'go', markersize=3, label="= Destination")
 
-            if measure2 == "kilometers": #Convert meters (in data) to kilometers for legend
-                b = [round((x/1000),0) for x in brksBins]
-                brksBins = b
-                del b
+        #-----------------------------
+        #LEGEND
+        #-----------------------------
 
-            brksCounts = breaks.counts[:-1] #Do not take into account NoData values
+        #Draw a map scale
+        self.drawMapscale(ax)
 
-            #Check if brksCounts and brksBins dismatches --> insert 0 values if necessary (to match the counts)
-            if len(brksBins) != len(brksCounts):
-                dif = len(brksBins)-len(brksCounts)
-                brksCounts = np.append(brksCounts,[0 for x in xrange(dif)])
-            else:
-                dif=0
+        #Set up title
+        plt.figtext(.852,.735,
+                    mapData['title'], size=9.5)
 
-            #List for measures which will be inserted to class labels
-            measureList = [measure for x in xrange(len(brksBins))]
 
-            #Class labels
-            jenks_labels = ["%0.0f %s (%0.1f %%)" % (b, msr, (c/13230.0)*100) for b, msr, c in zip(brksBins[:-1],measureList[:-1],brksCounts[:-1])]
+        #Plot copyright texts
+        copyr = "%s MetropAccess project, University of Helsinki, 2014\nLicensed under a Creative Commons Attribution 4.0 International License" % (unichr(0xa9))
 
-            if Manual == True:
-                if "dist" in AttributeParameter:
-                    jenks_labels.insert(int(maxBin), '>' + maxClassInfo +' km (%0.1f %%)' % ((brksCounts[-1]/13230.0)*100))
-                else:
-                    jenks_labels.insert(int(maxBin), '>'+ maxClassInfo +' min (%0.1f %%)' % ((brksCounts[-1]/13230.0)*100))
+        plt.figtext(.24,.078,copyr,fontsize=4.5)
 
-            jenks_labels.insert(NoData, 'NoData (%0.1f %%)' % (NullP))
+        #----------------
+        #Add a colour bar
+        #----------------
 
-            #Use modified colormap ('my_colormap') - Choose here the default colormap which is used as a startpoint --> cm.YourColor'sName (eg. cm.Blues) - See available Colormaps: http://matplotlib.org/examples/color/colormaps_reference.html
-            cmap = self.my_colormap(cm.RdYlBu, len(bins))
+        #Set arbitary location (and size) for the colorbar
+        axColor = plt.axes([.86, .15, .016,.52]) #([DistFromLeft, DistFromBottom, Width, Height])
 
-            #Draw grid with grey outlines
-            df_map['Grid'] = df_map['poly'].map(lambda x: PolygonPatch(x, ec='#555555', lw=.2, alpha=1., zorder=4)) #RGB color-codes can be found at http://www.rapidtables.com/web/color/RGB_Color.htm
-            pc = PatchCollection(df_map['Grid'], match_original=True)
+        cb = self.colorbar_index(ncolors=len(mapData['labels']), cmap=mapData['cmap'], labels=mapData['labels'], cax=axColor)#, shrink=0.5)#, orientation="vertical", pad=0.05,aspect=20)#,cax=cbaxes) #This is a function --> see at the beginning of the code. #, cax=cbaxes shrink=0.5,
+        cb.ax.tick_params(labelsize=5.5)
 
-            #-----------------------------
-            #Reclassify data to value range 0.0-1.0 (--> colorRange is 0.0-1.0)
-            if Manual == True:
+        #Travel summary texts
+        self.drawSummary(mapData['summary'])
 
-                colbins = np.linspace(0.0,1.0, len(bins))
-                colbins = colbins-0.001
-                colbins[0], colbins[-1] = 0.0001, 1.0
+        #Plot Legend symbol
+        ax.legend(bbox_to_anchor=(.97, 0.07), fontsize=5.5, frameon=False, numpoints=1) #1.265     bbox_to_anchor=(x,y)  --> arbitary location for legend, more info: http://matplotlib.org/api/legend_api.html
+        start = self.stageTime(basename, 'draw', start)
 
-                reclassification = {}
-                for index in range(len(bins)):
-                    reclassification[index] = colbins[index]
+        #--------------------------------------------------------
+        #Travel time and population (catchment areas) histograms
+        #--------------------------------------------------------
 
-                reclassification['_reclassify'] = self.reclassify
+        #New axes for travel time/distance histogram
+        ax = plt.axes([.98, .39, .16, .14], axisbg='w') #([DistFromLeft, DistFromBottom, Width, Height])
+        self.drawHistogram(ax, mapData['histData'], mapData['measure2'])
 
-                reclass = []
-                dataList = list(df_map['jenks_bins'])
+        #Set histogram title
+        plt.figtext(.975, .535,
+                    "Travel %s histogram" % mapData['titleMeas'],ha='left', va='bottom', size=5.7, style='italic')
 
-                for value in dataList:
-                    reclass.append(self.reclassify(reclassification, value))
+        #----------------------------------------------------
+        #New axes for population diagram
 
-                df_map['jenks_binsR'] = reclass
-            else:
-                norm = Normalize()
-                df_map['jenks_binsR'] = norm(df_map['jenks_bins'].values)
-
-            #-----------------------------
-
-            #Impose colour map onto the patch collection
-            pc.set_facecolor(cmap(df_map['jenks_binsR'].values))
-
-            #Add colored Grid to map
-            ax.add_collection(pc)
-
-            #Add coastline to the map
-            self.C['Polys'] = self.C['poly'].map(lambda x: PolygonPatch(x, fc='#606060', ec='#555555', lw=.25, alpha=.88, zorder=4)) #Alpha adjusts transparency, fc='facecolor', ec='edgecolor'
-            cpc = PatchCollection(self.C['Polys'], match_original=True)
-            ax.add_collection(cpc)
-
-            #Add roads to the map
-            for feature in self.R:
-                xx,yy=feature.xy
-                self.B.plot(xx,yy, linestyle='solid', color='#606060', linewidth=0.7, alpha=.6)
-
-            #Add metro to the map
-            for line in self.M: #metroLines is a shapely MultiLineString object consisting of multiple lines (is iterable)
-                x,y=line.xy
-                self.B.plot(x,y, color='#FF2F2F', linewidth=0.65, alpha=.4)
-
-            #----------------------
-            #GENERATE TARGET POINT
-            #----------------------
-            #Generate YKR_ID from csv name
-            ykrID = int(self.basename.split('_')[2])
-
-            #Find index of target YKR_ID
-            tIndex = df_map.YKR_ID[df_map.YKR_ID == ykrID].index.tolist()
-            trow = df_map[tIndex[0]:tIndex[0]+1]
-            targetPolygon = trow.poly
-            centroid = targetPolygon.values[0].centroid #Get centroid of the polygon --> Returns shapely polygon point-type object
-
-            self.B.plot(
-                centroid.x,centroid.y,
-                'go', markersize=3, label="= Destination")
-
-            #-----------------------------
-            #LEGEND
-            #-----------------------------
-
-            #Draw a map scale
-            self.B.drawmapscale(
-                coords[0] + 0.47, coords[1] + 0.013, #Etisyys vasemmalta, etisyys alhaalta: plussataan koordinaatteihin asteissa
-                coords[0], coords[1],
-                #10.,
-                10.,
-                barstyle='fancy', labelstyle='simple',yoffset=200, #yoffset determines the height of the mapscale
-                fillcolor1='w', fillcolor2='#909090', fontsize=6,  # black= #000000
-                fontcolor='#202020',
-                zorder=5)
-
-            #Set up title
-            if "PT" in AttributeParameter:
-                tMode = "public transportation"
-            elif "Car" in AttributeParameter:
-                tMode = "car"
-            elif "Walk" in AttributeParameter:
-                tMode = "walking"
-
-            titleText = "Travel %s to %s (YKR-ID) \n by %s" % (titleMeas,str(ykrID),tMode)
-            plt.figtext(.852,.735,
-                        titleText, size=9.5)
-
-
-            #Plot copyright texts
-            copyr = "%s MetropAccess project, University of Helsinki, 2014\nLicensed under a Creative Commons Attribution 4.0 International License" % (unichr(0xa9))
-
-            plt.figtext(.24,.078,copyr,fontsize=4.5)
-
-            #----------------
-            #Add a colour bar
-            #----------------
-
-            #Set arbitary location (and size) for the colorbar
-            axColor = plt.axes([.86, .15, .016,.52]) #([DistFromLeft, DistFromBottom, Width, Height])
-
-            cb = self.colorbar_index(ncolors=len(jenks_labels), cmap=cmap, labels=jenks_labels, cax=axColor)#, shrink=0.5)#, orientation="vertical", pad=0.05,aspect=20)#,cax=cbaxes) #This is a function --> see at the beginning of the code. #, cax=cbaxes shrink=0.5,
-            cb.ax.tick_params(labelsize=5.5)
-
-            #Inform travel sum of the whole grid (i.e. centrality of the location)
-            #Travel time
-            if measure2 == "minutes":
-                tMean = histData.mean().values[0]
-                tMedian=histData.median().values[0]
-                tMax = histData.max().values[0]
-                tMin = histData.min().values[0]
-                tStd=histData.std().values[0]
-                travelSummary = "Summary:"
-                travelMean = "Mean: %0.0f %s" % (tMean, measure2)
-                travelMedian = "Median: %0.0f %s" % (tMedian, measure2)
-                travelStd = "Std: %0.0f %s" % (tStd,measure2)
-                travelRange = "Range: %0.0f-%0.0f %s" % (tMin,tMax,measure2)
-
-            #Travel distance
-            else:
-                h = histData.values/1000
-                histData = pd.DataFrame(h)
-                del h
-                tMean = histData.mean().values[0]
-                tMedian=histData.median().values[0]
-                tMax = histData.max().values[0]
-                tMin = histData.min().values[0]
-                tStd=histData.std().values[0]
-                travelSummary = "Summary:"
-                travelMean = "Mean: %0.1f %s" % (tMean, measure2)
-                travelMedian = "Median: %0.1f %s" % (tMedian, measure2)
-                travelStd = "Std: %0.1f %s" % (tStd,measure2)
-                travelRange = "Range: %0.1f-%0.1f %s" % (tMin,tMax,measure2)
-
-
-            #Write information to a statistics file
-            mInfo = "%s;%0.0f;%0.0f;%0.0f;%0.0f;%0.0f\n" % ( str(ykrID), tMean, tMedian, tStd, tMin, tMax)
-            self.writeStatistics(mInfo)
-
-            #Helper variables for moving Summary statistic texts
-            initialPos = .58 #.15  #.44
-            initialXPos = .975 #.20 #.97
-            textSize = 5.25
-            split = 0.018
-
-            #Plot Travel Summary title
-            plt.figtext(initialXPos, initialPos+split*4,
-                       travelSummary, ha='left', va='bottom', color='#404040', size=textSize, style='normal',fontweight='bold')
-
-            #Plot Travel Summary mean
-            plt.figtext(initialXPos, initialPos+split*3,
-                       travelMean,ha='left', va='bottom', size=textSize, color='b')
-
-            #Plot Travel Summary median
-            plt.figtext(initialXPos, initialPos+split*2,
-                       travelMedian,ha='left', va='bottom', size=textSize, color='r')
-
-            #Plot Travel Summary Standard deviation
-            plt.figtext(initialXPos, initialPos+split,
-                       travelStd,ha='left', va='bottom', size=textSize)
-
-            #Plot Travel Summary Range
-            plt.figtext(initialXPos, initialPos,
-                       travelRange,ha='left', va='bottom', size=textSize)
-
-            #Plot Legend symbol
-            ax.legend(bbox_to_anchor=(.97, 0.07), fontsize=5.5, frameon=False, numpoints=1) #1.265     bbox_to_anchor=(x,y)  --> arbitary location for legend, more info: http://matplotlib.org/api/legend_api.html
-
-            #--------------------------------------------------------
-            #Travel time and population (catchment areas) histograms
-            #--------------------------------------------------------
-
-            #New axes for travel time/distance histogram
-            ax = plt.axes([.98, .39, .16, .14], axisbg='w') #([DistFromLeft, DistFromBottom, Width, Height])
-
-            #Add histogram
-            n, bins, patches = ax.hist(histData.values, 100, normed=False, facecolor='green', alpha=0.75, rwidth=0.5, orientation="vertical")
-            ax.axvline(histData.median(), color='r', linestyle='solid', linewidth=1.8)
-            ax.axvline(histData.mean(), color='b', linestyle='solid', linewidth=1.0)
-
-            if measure2 == "minutes":
-                ax.set_xlabel("t(min)", fontsize=5,labelpad=1.5)
-                xupLim = 250 #upper limit for x-axis
-            else:
-                ax.set_xlabel("km", fontsize=5,labelpad=1.5)
-                xupLim = 100 #upper limit for x-axis
+        ax = plt.axes([.98, .17, .16, .14], axisbg='w') #([DistFromLeft, DistFromBottom, Width, Height])
+        self.drawPopulation(ax, mapData['cumPop'], mapData['measure2'])
 
-            #Set valuelimits for axes
-            ax.set_xlim(0,xupLim-30)
+        #Set histogram title
+        plt.figtext(.975, .315,
+                    self.populationTitle(mapData['measure2']),ha='left', va='bottom', size=5.7, style='italic')
+        start = self.stageTime(basename, 'histograms', start)
 
-            if max(n) < 1000: #ymax will be set to 1000 if count of individual bin is under 1000, else 1500
-                yMax = 1000
-            else:
-                yMax = 1600
+        #-----------------------
+        #Save map to disk
+        #-----------------------
 
-            ax.set_ylim(0,yMax)
+        fig.set_size_inches(9.22, 6.35) #(Width, Height)
 
-            #Set histogram title
-            plt.figtext(.975, .535,
-                        "Travel %s histogram" % titleMeas,ha='left', va='bottom', size=5.7, style='italic')
+        plt.savefig(outputPath, dpi=self.dpi, alpha=True, bbox_inches='tight')
+        plt.close(fig)
+        self.stageTime(basename, 'save', start)
 
-            #Adjust tick font sizes and set yaxis to right
-            ax.tick_params(axis='both', direction="out",labelsize=4.5, pad=1,
-                           labelright=True,labelleft=False, top=False, left=False,
-                           color='k', length=3, width=.9)
 
-            ax.xaxis.set_ticks(np.arange(0,xupLim-30,30))
+class MapTemplate:
+    """Persistent figure for drawing many maps: the grid, coastline, roads, metro and the legend scaffolding are built only once,
+    each map only recolours the grid and updates the texts, colour bar, histograms and the destination point.
 
-            gridlines = ax.get_xgridlines()
-            gridlines.extend( ax.get_ygridlines() )
+    With the 'raster' renderer the map frame is a single image: grid cell of each pixel is solved once (cellIndex) and
+    the colours of a map are looked up from the cell colours and composited under the cached outlines, coastline, roads and metro."""
+    def __init__(self, MapGenerator):
+        """Constructor"""
+        self.MG = MapGenerator
+        self.bbox = {}
+        self.createFigure()
+
+    def createFigure(self):
+        from descartes import PolygonPatch
+        MG = self.MG
 
-            for line in gridlines:
-                line.set_linewidth(.28)
-                line.set_linestyle('dotted')
+        #Format figure (size is fixed already here as the figure is reused)
+        self.fig = plt.figure(figsize=(9.22, 6.35))
 
-            ax.grid(True)
+        #Picture frame for Map
+        gs = gridspec.GridSpec(12, 12)
+        self.ax = plt.subplot(gs[:,:],axisbg='w', frame_on=False)
+        ax = self.ax
+
+        if MG.renderer == 'raster':
+            #Grid, coastline, roads and metro as one image (updated for each map)
+            self.createRaster()
+            self.image = ax.imshow(self.rasterColors(np.ones((len(MG.Y), 4))), extent=self.extent, origin='upper', interpolation='nearest', zorder=1)
+            MG.B.set_axes_limits(ax=ax)
+        else:
+            #Grid with grey outlines (facecolors are updated for each map)
+            gridPatches = MG.Y['poly'].map(lambda x: PolygonPatch(x, ec='#555555', lw=.2, alpha=1., zorder=4))
+            self.grid = PatchCollection(gridPatches, match_original=True)
+            ax.add_collection(self.grid)
+            del gridPatches
+
+        #Coastline, roads and metro
+        if MG.renderer == 'raster':
+            pass
+        elif MG.staticBackground:
+            #Layers are drawn only once to an image that lies on top of the grid but under the destination point (like the vector layers)
+            img, extent = self.rasterizeStaticLayers()
+            ax.imshow(img, extent=extent, origin='upper', interpolation='nearest', zorder=1.9)
+            MG.B.set_axes_limits(ax=ax)
+            del img
+        else:
+            MG.drawStaticLayers(ax)
 
-            #----------------------------------------------------
-            #New axes for population diagram
+        #Target point (moved for each map)
+        self.target = MG.B.plot(
+            MG.coords[0],MG.coords[1],
+            'go', markersize=3, label="= Destination", ax=ax)[0]
 
-            ax = plt.axes([.98, .17, .16, .14], axisbg='w') #([DistFromLeft, DistFromBottom, Width, Height])
+        #Map scale
+        MG.drawMapscale(ax)
 
-            #Make dataframe from Ykr-population
-            pop = pd.read_csv(self.Ypop, sep=';')
+        #Title
+        self.title = plt.figtext(.852,.735,
+                                 "", size=9.5)
 
-            #Use original Matrix without NoData values
-            MatrixData.replace(to_replace={AttributeParameter: {-1: np.nan}}, inplace=True)
+        #Copyright texts
+        copyr = "%s MetropAccess project, University of Helsinki, 2014\nLicensed under a Creative Commons Attribution 4.0 International License" % (unichr(0xa9))
+        plt.figtext(.24,.078,copyr,fontsize=4.5)
 
-            #Join population information and time matrix
-            join = pd.merge(left=MatrixData, right=pop, how='outer', left_on='from_id', right_on='YKR_ID')
+        #Axes for the colour bar
+        self.axColor = plt.axes([.86, .15, .016,.52])
 
-            #Sort data by attribute parameter
-            sorted = join.sort(columns=[AttributeParameter])
+        #Travel summary texts
+        self.summary = MG.drawSummary(("", "", "", "", ""))
 
-            #Aggregate data by AttributeParameter
-            aggre = pd.DataFrame(sorted.groupby(AttributeParameter).sum().Population)
+        #Legend symbol
+        ax.legend(bbox_to_anchor=(.97, 0.07), fontsize=5.5, frameon=False, numpoints=1)
 
-            #Create attribute from index
-            aggre[AttributeParameter] = aggre.index
+        #Axes and titles for the histograms
+        self.axHist = plt.axes([.98, .39, .16, .14], axisbg='w')
+        self.histTitle = plt.figtext(.975, .535,
+                                     "",ha='left', va='bottom', size=5.7, style='italic')
 
-            #Create cumulative population attribute
-            aggre['cumPop'] = aggre['Population'].cumsum()
+        self.axPop = plt.axes([.98, .17, .16, .14], axisbg='w')
+        self.popTitle = plt.figtext(.975, .315,
+                                    "",ha='left', va='bottom', size=5.7, style='italic')
 
-            #Reset index and determine AttributeParameter as float (matplotlib requires for it to work)
-            aggre.reset_index(inplace=True, drop=True)
-            aggre[AttributeParameter].astype(float)
+    def offscreenFrame(self):
+        #Offscreen figure with the same size, resolution and map frame as the template, background is transparent
+        fig = Figure(figsize=self.fig.get_size_inches(), dpi=self.MG.dpi)
+        canvas = FigureCanvasAgg(fig)
+        fig.patch.set_alpha(0.0)
+        gs = gridspec.GridSpec(12, 12)
+        ax = fig.add_subplot(gs[:,:], frame_on=False)
+        ax.patch.set_visible(False)
+        return canvas, ax
+
+    def cutFrame(self, canvas, ax):
+        #Draw the offscreen figure and cut the map frame from it. Returns the RGBA image and its extent in map coordinates.
+        self.MG.B.set_axes_limits(ax=ax)
+        canvas.draw()
+
+        #Map frame rounded outwards to whole pixels (y-axis of the image points down)
+        width, height = canvas.get_width_height()
+        buf = np.frombuffer(canvas.buffer_rgba(), np.uint8).reshape(height, width, 4)
+        x0, y0, x1, y1 = ax.bbox.extents
+        x0, y0 = int(np.floor(x0)), int(np.floor(y0))
+        x1, y1 = int(np.ceil(x1)), int(np.ceil(y1))
+        img = buf[height-y1:height-y0, x0:x1].copy()
+
+        #Extent of the image in map coordinates
+        (left, bottom), (right, top) = ax.transData.inverted().transform([(x0, y0), (x1, y1)])
+        return img, (left, right, bottom, top)
+
+    def rasterizeStaticLayers(self):
+        """Draws coastline, roads and metro once to an RGBA image that has the resolution and extent of the map frame.
+        Returns the image and its extent in map coordinates."""
+        canvas, ax = self.offscreenFrame()
+        self.MG.drawStaticLayers(ax)
+        return self.cutFrame(canvas, ax)
+
+    def createRaster(self):
+        """Solves the grid cell of each pixel of the map frame and draws the cell outlines, coastline, roads and metro to a cached overlay"""
+        from descartes import PolygonPatch
+        MG = self.MG
+        Ncells = len(MG.Y)
+        polys = list(MG.Y['poly'].values)
+
+        #Draw every cell with its own colour (index+1 encoded to RGB) without antialiasing --> pixel coverage is the same as with Agg
+        ids = np.arange(1, Ncells+1)
+        codes = np.column_stack((ids & 255, (ids >> 8) & 255, (ids >> 16) & 255, np.repeat(255, Ncells))) / 255.0
+        canvas, ax = self.offscreenFrame()
+        cells = PatchCollection([PolygonPatch(x) for x in polys], facecolors=codes, edgecolors='none', linewidths=0, antialiaseds=False)
+        ax.add_collection(cells)
+        img, self.extent = self.cutFrame(canvas, ax)
+
+        #Cell index of each pixel (0 = no grid cell, i+1 = row i in the grid)
+        img = img.astype(np.int32)
+        self.cellIndex = np.where(img[:,:,3] == 255, img[:,:,0] + (img[:,:,1] << 8) + (img[:,:,2] << 16), 0)
+        del cells, canvas, ax, img
+
+        #Grid outlines, coastline, roads and metro on top of the grid
+        canvas, ax = self.offscreenFrame()
+        ax.add_collection(PatchCollection([PolygonPatch(x) for x in polys], facecolors='none', edgecolors='#555555', linewidths=.2))
+        MG.drawStaticLayers(ax)
+        overlay, extent = self.cutFrame(canvas, ax)
+        del canvas, ax
+
+        #Overlay as premultiplied colours (0-255, +0.5 for rounding) and weights of the grid colours under it
+        alpha = overlay[:,:,3:4].astype(np.float32) / 255.0
+        self.overlayRGB = overlay[:,:,:3].astype(np.float32) * alpha + 0.5
+        self.underWeight = 1.0 - alpha
+        del overlay, alpha
+
+        #Colour lookup table (row 0 is the white background of the map frame)
+        self.lut = np.empty((Ncells+1, 3), dtype=np.float32)
+        self.lut[0] = 255.0
+
+    def rasterColors(self, gridColors):
+        #Map frame image of one map: cell colours through the lookup table, overlay composited on top
+        self.lut[1:] = gridColors[:,:3] * 255.0
+        rgb = self.lut[self.cellIndex]
+        rgb *= self.underWeight
+        rgb += self.overlayRGB
+        return rgb.astype(np.uint8)
+
+    def render(self, mapData, outputPath):
+        """Updates the template with the data of one map and saves it to disk"""
+        MG = self.MG
+        basename = mapData['basename']
+        start = time.time()
 
-            #print aggre[0:10]
+        #Make the template the current figure (colour bar is drawn with pyplot)
+        plt.figure(self.fig.number)
 
-            #Create filled curve plot from the cumulative population
-            ax.fill_between(aggre.index,aggre['cumPop']/1000,0, interpolate=True, lw=1, facecolor='green', alpha=0.6)
+        #Recolour the grid
+        if MG.renderer == 'raster':
+            self.image.set_data(self.rasterColors(mapData['gridColors']))
+        else:
+            self.grid.set_facecolor(mapData['gridColors'])
+
+        #Move target point
+        self.target.set_data([mapData['centroid'][0]], [mapData['centroid'][1]])
+
+        #Texts
+        self.title.set_text(mapData['title'])
+        for text, value in zip(self.summary, mapData['summary']):
+            text.set_text(value)
+        self.histTitle.set_text("Travel %s histogram" % mapData['titleMeas'])
+        self.popTitle.set_text(MG.populationTitle(mapData['measure2']))
+
+        #Colour bar (number of classes may change between maps)
+        self.axColor.cla()
+        cb = MG.colorbar_index(ncolors=len(mapData['labels']), cmap=mapData['cmap'], labels=mapData['labels'], cax=self.axColor)
+        cb.ax.tick_params(labelsize=5.5)
+        start = MG.stageTime(basename, 'draw', start)
+
+        #Histograms
+        self.axHist.cla()
+        MG.drawHistogram(self.axHist, mapData['histData'], mapData['measure2'])
+
+        self.axPop.cla()
+        MG.drawPopulation(self.axPop, mapData['cumPop'], mapData['measure2'])
+        start = MG.stageTime(basename, 'histograms', start)
+
+        #Bounding box is solved at the first map of each attribute (layout is the same for all maps of an attribute)
+        attribute = mapData['attribute']
+        if not attribute in self.bbox:
+            self.bbox[attribute] = MGW.tightBbox(self.fig, MG.dpi)
+
+        #Save map to disk
+        MG.writer.save(self.fig, outputPath, MG.dpi, self.bbox[attribute])
+        self.pruneTransforms()
+        MG.stageTime(basename, 'save', start)
+
+    def pruneTransforms(self):
+        #Transforms of the figure and the axes keep a weak reference to every transform derived from them. matplotlib does not remove
+        #the references of the artists that are replaced for each map (colour bar, histograms, ticks) --> remove the dead ones.
+        nodes = [self.fig.transFigure, self.fig.dpi_scale_trans]
+        for ax in self.fig.axes:
+            nodes.extend([ax.transData, ax.transAxes, ax.get_xaxis_transform(), ax.get_yaxis_transform()])
+        seen = set()
+        while len(nodes) > 0:
+            node = nodes.pop()
+            if id(node) in seen:
+                continue
+            seen.add(id(node))
+            parents = getattr(node, '_parents', {})
+            for key, ref in parents.items():
+                if ref() == None:
+                    del parents[key]
+            nodes.extend(value for value in vars(node).values() if isinstance(value, TransformNode))
+
+    def close(self):
+        plt.close(self.fig)
 
-            #Set valuelimits for axes
-            ax.set_xlim(0,xupLim-50)
-            ax.set_ylim(-10,aggre['cumPop'].max()/1000+50)
 
+#---------------------------------------------
+#PREFETCHING PIPELINE
+#---------------------------------------------
 
-            gridlines = ax.get_xgridlines()
-            gridlines.extend( ax.get_ygridlines() )
+#End of the files (passed through the queues)
+_END = "end"
+
+class MapPipeline:
+    """Generates maps in three stages connected with bounded queues: a reader thread reads the upcoming matrices,
+    a preparer thread joins and classifies them, and the calling thread draws and saves the maps
+    (matplotlib is used only from the calling thread). Reading, preparing and PNG encoding of different maps overlap."""
+    def __init__(self, MapGenerator, prefetch=2):
+        """Constructor, prefetch is the size of the queues between the stages"""
+        self.MG = MapGenerator
+        self.prefetch = prefetch
+        self.stopped = False
+
+    def put(self, queue, item):
+        #Put that gives up if the pipeline is stopped (nobody takes the items anymore)
+        while not self.stopped:
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def get(self, queue):
+        #Get that gives up if the pipeline is stopped
+        while not self.stopped:
+            try:
+                return queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        return _END
+
+    def readFiles(self, files, output):
+        #Stage 1: read the matrices. Items are [inputFile, data, exception, seconds used]
+        for inputFile in files:
+            start = time.time()
+            try:
+                item = [inputFile, self.MG.readMatrix(inputFile), None, 0.0]
+            except Exception as e:
+                item = [inputFile, None, e, 0.0]
+            item[3] = time.time()-start
+            if not self.put(output, item):
+                return
+        self.put(output, _END)
+
+    def prepareFiles(self, input, output):
+        #Stage 2: join the matrices to the grid and classify them
+        while True:
+            item = self.get(input)
+            if item is _END:
+                break
+            if item[2] == None:
+                start = time.time()
+                try:
+                    item[1] = self.MG.prepareMaps(item[0], item[1])
+                except Exception as e:
+                    item[1], item[2] = None, e
+                item[3] += time.time()-start
+            if not self.put(output, item):
+                return
+        self.put(output, _END)
+
+    def run(self, files):
+        """Generator that yields (basename, lasted/exception) of each file in the order of the files (like GenerateMap)"""
+        self.stopped = False
+        if not self.MG.collectStatistics:
+            self.MG.createStatistics()
+
+        matrices = Queue.Queue(self.prefetch)
+        prepared = Queue.Queue(self.prefetch)
+
+        stages = [threading.Thread(target=self.readFiles, args=(files, matrices)),
+                  threading.Thread(target=self.prepareFiles, args=(matrices, prepared))]
+        for stage in stages:
+            stage.daemon = True
+            stage.start()
 
-            for line in gridlines:
-                line.set_linewidth(.28)
-                line.set_linestyle('dotted')
+        try:
+            while True:
+                item = self.get(prepared)
+                if item is _END:
+                    break
+
+                inputFile, maps, exception, lasted = item
+                self.MG.basename = os.path.basename(inputFile)[:-4]
+
+                #Stage 3: draw the maps and save them to disk
+                if exception == None:
+                    start = time.time()
+                    exception = self.MG.saveMaps(maps)
+                    lasted += time.time()-start
+
+                del maps, item
+                if exception != None:
+                    yield self.MG.basename, exception
+                else:
+                    yield self.MG.basename, int(lasted)
+        finally:
+            #Stop the threads also when the caller stops iterating
+            self.stopped = True
+            for stage in stages:
+                stage.join()
+            self.MG.flushImages()
 
-            ax.grid(True)
-            ax.tick_params(axis='both', direction="out",labelsize=4.5, pad=1,
-                                        labelright=True,labelleft=False, top=False, left=False,
-                                        color='k', length=3, width=.9)
-            ax.xaxis.set_ticks(np.arange(0,xupLim-30,30))
+#---------------------------------------------
+#STATISTICS ONLY (no maps)
+#---------------------------------------------
 
-            if measure2 == "minutes":
-                ax.set_xlabel("t(min)", fontsize=5,labelpad=1.5)
-                measure3 = 'minutes'
+def statisticsRows(ykrIds, values, attribute):
+    """Statistics rows (YKR_ID;mean;median;std;min;max) of a block of destinations.
+    values has one row per destination in the order of the grid (NoData as NaN), destinations without any values are left out."""
+    hasData = ~np.all(np.isnan(values), axis=1)
+    ykrIds, values = ykrIds[hasData], values[hasData]
+
+    #Distances are reported in kilometers (like in the maps)
+    if not "time" in attribute:
+        values = values/1000
+
+    tMean = np.nanmean(values, axis=1)
+    tMedian = np.nanmedian(values, axis=1)
+    tStd = np.nanstd(values, axis=1, ddof=1)
+    tMin = np.nanmin(values, axis=1)
+    tMax = np.nanmax(values, axis=1)
+
+    return ["%s;%0.0f;%0.0f;%0.0f;%0.0f;%0.0f\n" % row for row in zip(ykrIds, tMean, tMedian, tStd, tMin, tMax)]
+
+class StatisticsGenerator:
+    """Computes the travel time statistics (MeanTravelTimes_<attribute>.csv) of all destinations without rendering the maps.
+    Matrices are read in blocks of destinations and the statistics of a block are computed at once.
+    attributes can be one attribute or a list of them (each matrix is read once for all of them)."""
+    def __init__(self, gridIndex, outputFolder, attributes, matrixStore=None, blockSize=256, binary=False, shard=None):
+        """Constructor"""
+        self.index = gridIndex
+        self.outputFolder = outputFolder
+        self.binary = binary
+        self.shard = shard
+        if isinstance(attributes, basestring):
+            attributes = [attributes]
+        self.attributes = list(attributes)
+        self.blockSize = blockSize
+
+        self.store = None
+        if matrixStore != None:
+            self.store = MGS.MatrixStore(matrixStore)
+
+            #Grid rows of the origins in the store
+            self.storeRows = self.index.rows(self.store.getOrigins())
+            self.storeInGrid = self.storeRows >= 0
+
+    def readBlock(self, files):
+        """Returns YKR_IDs of the destinations and the values of each attribute as a dictionary (one row per destination
+        in the order of the grid, NoData as NaN). Destinations that are not in the grid or that can not be read are left out."""
+        destinations = []
+        for inputFile in files:
+            ykrID = MGS.destinationId(inputFile)
+            if self.index.row(ykrID) < 0:
+                print "%s: destination is not in the YKR grid" % os.path.basename(inputFile)
+            elif self.store != None and not ykrID in self.store.destRow:
+                print "%s: destination is not in the matrix store" % os.path.basename(inputFile)
             else:
-                measure3 = 'km'
-                ax.set_xlabel("km", fontsize=5,labelpad=1.5)
+                destinations.append((ykrID, inputFile))
+
+        values = {}
+        for attribute in self.attributes:
+            values[attribute] = np.empty((len(destinations), len(self.index.ids)))
+            values[attribute].fill(np.nan)
+
+        if self.store != None:
+            #One read of the destination rows from the memory-mapped arrays
+            ykrIds = np.array([d[0] for d in destinations], dtype=np.int64)
+            storeRows = [self.store.destRow[d] for d in ykrIds]
+            for attribute in self.attributes:
+                data = self.store.array(attribute)[storeRows][:, self.storeInGrid].astype(float)
+                data[data == self.store.meta['attributes'][attribute]['nodata']] = np.nan
+                values[attribute][:, self.storeRows[self.storeInGrid]] = data
+            return ykrIds, values
+
+        ykrIds = []
+        for ykrID, inputFile in destinations:
+            try:
+                MatrixData = pd.read_csv(inputFile, sep=';', usecols=['from_id'] + self.attributes)
+            except Exception as e:
+                print "%s: %s" % (os.path.basename(inputFile), e)
+                continue
+            for attribute in self.attributes:
+                data = MatrixData[attribute].values.astype(float)
+                data[data == -1] = np.nan
+                values[attribute][len(ykrIds)] = self.index.align(MatrixData['from_id'].values, data)
+            ykrIds.append(ykrID)
+
+        for attribute in self.attributes:
+            values[attribute] = values[attribute][:len(ykrIds)]
+        return np.array(ykrIds), values
+
+    def blocks(self, files):
+        """Generator that yields the processed file names and the statistics rows of each attribute (dictionary) for each block of destinations"""
+        for start in xrange(0, len(files), self.blockSize):
+            block = files[start:start+self.blockSize]
+            ykrIds, values = self.readBlock(block)
+            rows = dict((attribute, statisticsRows(ykrIds, values[attribute], attribute)) for attribute in self.attributes)
+            yield [os.path.basename(f)[:-4] for f in block], rows
+
+    def writeStatistics(self, rows):
+        #Whole statistics table of each attribute is written at once
+        for attribute in self.attributes:
+            writeStatisticsTable(self.outputFolder, attribute, rows[attribute], self.shard)
+            if self.binary:
+                writeStatisticsBinary(self.outputFolder, attribute, self.shard)
+
+    def run(self, files):
+        """Computes and writes the statistics of all files. Returns the number of statistics rows of each attribute."""
+        rows = dict((attribute, []) for attribute in self.attributes)
+        for basenames, blockRows in self.blocks(files):
+            for attribute in self.attributes:
+                rows[attribute].extend(blockRows[attribute])
+        self.writeStatistics(rows)
+        return dict((attribute, len(rows[attribute])) for attribute in self.attributes)
 
-            #Set histogram title
-            plt.figtext(.975, .315,
-                        "Population (per 1000) reached within (x) %s" % measure3,ha='left', va='bottom', size=5.7, style='italic')
+#---------------------------------------------
+#PARALLEL RENDERING (worker processes)
+#---------------------------------------------
 
-            #-----------------------
-            #Save map to disk
-            #-----------------------
+#MapGenerator of the current worker process (created only once by initRenderWorker)
+_workerMG = None
 
-            fig.set_size_inches(9.22, 6.35) #(Width, Height)
+def initRenderWorker(Parameters, options):
+    """Initializer for multiprocessing.Pool: creates MapInstance and MapGenerator once per worker process (options are MapGenerator keyword arguments)"""
+    global _workerMG
 
-            outputPath = os.path.join(self.outputFolder, self.basename) + AttributeParameter + ".png"
+    #Workers only write images to disk
+    plt.switch_backend('Agg')
 
-            plt.savefig(outputPath, dpi=300, alpha=True, bbox_inches='tight')
-            plt.close() #or plt.close('all') --> closes all figure windows
+    Ykr, Ykr_pop, Coast, Roads, Metro, outputF, travelMode, classifMethod, Nclasses, cacheFolder = Parameters
 
-            end = time.time()
-            lasted = int(end-start)
-            return lasted
+    Geometries = MapInstance(Ykr, Coast, Roads, Metro, cacheFolder)
+    _workerMG = MapGenerator(Geometries.getBasemap(), Geometries.getYkr(), Ykr_pop, Geometries.getCoast(), Geometries.getRoads(), Geometries.getMetro(),
+                             outputF, travelMode, classifMethod, Geometries.getCoords(), Nclasses, collectStatistics=True, gridIndex=Geometries.getGridIndex(), **options)
+    del Geometries
 
-        except Exception as e:
-            return e
\ No newline at end of file
+def renderWorkerFile(inputFile):
+    """Generates a map in a worker process, returns (basename, lasted/exception, statistics rows, render cache entries, stage timings)
+    to the parent process"""
+    result = _workerMG.GenerateMap(inputFile)
+
+    #Map has to be on disk before the worker reports it (worker processes may be terminated after the last map)
+    errors = _workerMG.flushImages()
+    if len(errors) > 0 and not isinstance(result, Exception):
+        result = errors[0][1]
+
+    #Render cache entries are written to the manifest by the parent process
+    cacheEntries = []
+    if _workerMG.cache != None:
+        cacheEntries = _workerMG.cache.popCommitted()
+
+    #Exceptions are passed to the parent process as text
+    if isinstance(result, Exception):
+        result = "%s: %s" % (result.__class__.__name__, result)
+
+    basename = os.path.basename(inputFile)[:-4]
+    return basename, result, _workerMG.popStatistics(), cacheEntries, _workerMG.popTimings(basename)
@@ -12,7 +12,7 @@ import os, sys
 from threading import Thread
 import wx
 from wx.lib.pubsub import pub
-import MetropAccess_MapGenerator_classes as MGC
+import MetropAccess_MapGenerator_batch as MGB
 import MetropAccess_MG_dialog as MGD
 
 
@@ -122,77 +122,18 @@ class AskInputs:
         return csvFiles
 
 
-class RunMapGenerator(Thread):
-
-    def __init__(self, tuple, files):
+class RunMapGenerator(MGB.MapRun, Thread):
+    """MapRun in a thread, progress is sent to the progress dialog (RunProgram)"""
+    def __init__(self, tuple, files, options=None):
         Thread.__init__(self)
-        self.inputF = tuple[0]
-        self.Ykr = tuple[1]
-        self.Ykr_pop = tuple[2]
-        self.Coast = tuple[3]
-        self.Roads = tuple[4]
-        self.Metro = tuple[5]
-        self.outputF = tuple[6]
-        self.travelMode = tuple[7]
-        self.classifMethod = tuple[8]
-        self.Nclasses = tuple[9]
-        self.files = files
+        MGB.MapRun.__init__(self, tuple, files, options)
         self.daemon = True
-        self.running = True
 
         #Start running the thread
         self.start()
 
-
-    def run(self):
-        while self.running:
-            self.mapInstance()
-            self.genMaps()
-
-    def mapInstance(self):
-
-        #Create matplotlib basemap instance and pandas dataframes that contains the geometries
-        Geometries = MGC.MapInstance(self.Ykr, self.Coast, self.Roads, self.Metro)
-
-        #Get geometries as matplotlib basemap instance (B) and pandas dataframes (Y,C,R,M)
-        B = Geometries.getBasemap()
-        Y = Geometries.getYkr()
-        C = Geometries.getCoast()
-        R = Geometries.getRoads()
-        M = Geometries.getMetro()
-        coords = Geometries.getCoords()
-
-        #Create MapGenerator instance
-        self.MG = MGC.MapGenerator(B, Y, self.Ykr_pop, C, R, M, self.outputF, self.travelMode, self.classifMethod, coords, self.Nclasses)
-
-        del Geometries, B, Y, C, R, M, coords
-        #------------------------------------------------
-    def genMaps(self):
-        #Iterate over files and create maps
-        i = 1
-        filecount = str(len(self.files))
-
-        for iFile in self.files:
-            basename = os.path.basename(iFile)[:-4]
-
-            #Set info texts
-            prosessedFiles = str(i)+'/' + filecount
-            wx.CallAfter(pub.sendMessage, "info", msg=(basename, self.travelMode, prosessedFiles))
-
-            print "Processing file: " + basename
-
-            #Run the MapGenerator
-            exception = self.MG.GenerateMap(iFile)
-            print exception
-
-            #Set progress bar
-            wx.CallAfter(pub.sendMessage, "update", msg="")
-
-            i+=1
-
-        self.MG.closeStatistics()
-        wx.CallAfter(pub.sendMessage, "exit", msg=self.outputF)
-        self.running = False
+    def notify(self, event, msg):
+        wx.CallAfter(pub.sendMessage, event, msg=msg)
 
 
 def main():
@@ -0,0 +1,180 @@
+# -*- coding: cp1252 -*-
+
+#---------------------------------------------
+# METROPACCESS-MAPGENERATOR
+# Accessibility Research Group
+# University of Helsinki
+# Authored by Henrikki Tenkanen
+# Licenced with GNU General Public License v3.
+#---------------------------------------------
+
+#Matrix store: all MetropAccess travel time matrices of a folder packed to binary arrays (one .npy file per attribute).
+#Rows of the arrays are destinations (time_to_<YKR_ID>.txt files) and columns are origins (from_id), so reading
+#the data of one map is reading one contiguous row from a memory-mapped file.
+#
+#Usage: python MetropAccess_MapGenerator_store.py <input folder (travel time matrices)> <store folder>
+
+import os, json, time, argparse
+import numpy as np
+import pandas as pd
+
+#Version of the store format
+STORE_VERSION = 1
+
+def storeDtype(attribute):
+    #Travel times (minutes) fit to uint16, distances (meters) are stored as int32. Returns (dtype, NoData value)
+    if "time" in attribute:
+        return 'uint16', 65535
+    return 'int32', -1
+
+def matrixFiles(inputFolder):
+    """Returns the travel time matrix files (time_to_*.txt) of a folder"""
+    csvFiles = []
+    for root,dirs,files in os.walk(inputFolder):
+        for filename in files:
+            if "time_to" in filename:
+                if filename.endswith(".txt"):
+                    csvFiles.append(os.path.join(root,filename))
+    return csvFiles
+
+def destinationId(inputFile):
+    #YKR_ID of the destination from file name (time_to_<YKR_ID>.txt)
+    return int(os.path.basename(inputFile)[:-4].split('_')[2])
+
+def buildMatrixStore(inputFolder, storeFolder, attributes=None):
+    """Converts the travel time matrices of inputFolder to a matrix store in storeFolder. Returns the number of destinations."""
+
+    files = sorted(matrixFiles(inputFolder), key=destinationId)
+    if len(files) == 0:
+        raise ValueError("No travel time matrices (time_to_*.txt) in %s" % inputFolder)
+
+    if not os.path.isdir(storeFolder):
+        os.makedirs(storeFolder)
+
+    #Origins and attributes are taken from the first matrix
+    first = pd.read_csv(files[0], sep=';')
+    origins = np.unique(first['from_id'].values).astype(np.int64)
+    if attributes == None:
+        attributes = [c for c in first.columns if not c in ['from_id', 'to_id']]
+    del first
+
+    destinations = np.array([destinationId(f) for f in files], dtype=np.int64)
+
+    #Arrays are written through memory maps (whole matrix never needs to fit in memory)
+    arrays = {}
+    meta = {'version': STORE_VERSION, 'attributes': {}}
+    for attribute in attributes:
+        dtype, noData = storeDtype(attribute)
+        fileName = attribute + ".npy"
+        arrays[attribute] = np.lib.format.open_memmap(os.path.join(storeFolder, fileName), mode='w+', dtype=dtype, shape=(len(destinations), len(origins)))
+        arrays[attribute][:] = noData
+        meta['attributes'][attribute] = {'file': fileName, 'dtype': dtype, 'nodata': noData}
+
+    start = time.time()
+    for row, inputFile in enumerate(files):
+        MatrixData = pd.read_csv(inputFile, sep=';', usecols=['from_id'] + list(attributes))
+
+        #Column of each origin in the store (origins that are not in the first matrix are left out)
+        cols = np.searchsorted(origins, MatrixData['from_id'].values)
+        cols[cols == len(origins)] = 0
+        valid = origins[cols] == MatrixData['from_id'].values
+        if not valid.all():
+            print "%s: %d origins not in the store" % (os.path.basename(inputFile), (~valid).sum())
+
+        for attribute in attributes:
+            dtype, noData = storeDtype(attribute)
+            values = MatrixData[attribute].values[valid]
+            if np.any(values > np.iinfo(dtype).max - 1):
+                raise ValueError("%s: %s values do not fit to %s" % (inputFile, attribute, dtype))
+            arrays[attribute][row, cols[valid]] = np.where(values < 0, noData, values)
+
+        if (row+1) % 100 == 0:
+            print "Packed %d/%d files (%0.1f files/s)" % (row+1, len(files), (row+1)/(time.time()-start))
+
+    for attribute in attributes:
+        arrays[attribute].flush()
+    del arrays
+
+    np.save(os.path.join(storeFolder, "origins.npy"), origins)
+    np.save(os.path.join(storeFolder, "destinations.npy"), destinations)
+
+    #Metadata is written last --> store is complete only when store.json exists
+    with open(os.path.join(storeFolder, "store.json"), 'w') as f:
+        json.dump(meta, f, indent=1)
+
+    return len(destinations)
+
+class MatrixStore:
+    """Reads travel time matrices from a matrix store (see buildMatrixStore). Arrays are memory-mapped when first needed."""
+    def __init__(self, storeFolder):
+        """Constructor"""
+        self.storeFolder = storeFolder
+
+        metaPath = os.path.join(storeFolder, "store.json")
+        if not os.path.isfile(metaPath):
+            raise IOError("%s is not a matrix store (store.json is missing)" % storeFolder)
+
+        with open(metaPath) as f:
+            self.meta = json.load(f)
+
+        if self.meta['version'] != STORE_VERSION:
+            raise IOError("Matrix store %s has version %s, expected %s" % (storeFolder, self.meta['version'], STORE_VERSION))
+
+        self.origins = np.load(os.path.join(storeFolder, "origins.npy"))
+        self.destinations = np.load(os.path.join(storeFolder, "destinations.npy"))
+        self.destRow = dict((d, i) for i, d in enumerate(self.destinations))
+        self.arrays = {}
+
+    def getAttributes(self):
+        return sorted(self.meta['attributes'].keys())
+
+    def getOrigins(self):
+        return self.origins
+
+    def getDestinations(self):
+        return self.destinations
+
+    def fileNames(self):
+        #Names of the original matrix files (MapGenerator identifies the maps with these)
+        return ["time_to_%d.txt" % d for d in self.destinations]
+
+    def array(self, attribute):
+        #Memory-mapped (destinations x origins) array of an attribute
+        if not attribute in self.arrays:
+            info = self.meta['attributes'][attribute]
+            self.arrays[attribute] = np.load(os.path.join(self.storeFolder, info['file']), mmap_mode='r')
+        return self.arrays[attribute]
+
+    def readDestination(self, ykrID, attribute):
+        """Returns the values of an attribute from all origins to a destination (NoData as -1, like in the text files)"""
+        if not ykrID in self.destRow:
+            raise KeyError("Destination %s is not in the matrix store %s" % (ykrID, self.storeFolder))
+
+        values = np.asarray(self.array(attribute)[self.destRow[ykrID]]).astype(np.int32)
+        values[values == self.meta['attributes'][attribute]['nodata']] = -1
+        return values
+
+    def readMatrix(self, ykrID, attributes=None):
+        """Returns the matrix of a destination as a DataFrame with the same columns as the text file"""
+        if attributes == None:
+            attributes = self.getAttributes()
+
+        MatrixData = pd.DataFrame({'from_id': self.origins, 'to_id': ykrID})
+        for attribute in attributes:
+            MatrixData[attribute] = self.readDestination(ykrID, attribute)
+        return MatrixData
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack MetropAccess travel time matrices (time_to_*.txt) to a memory-mapped matrix store.")
+    parser.add_argument("inputFolder", help="Folder containing the travel time matrices")
+    parser.add_argument("storeFolder", help="Output folder for the matrix store")
+    parser.add_argument("--attributes", nargs='+', default=None, help="Attributes to store (default: all)")
+    args = parser.parse_args()
+
+    start = time.time()
+    count = buildMatrixStore(args.inputFolder, args.storeFolder, args.attributes)
+    print "Packed %d travel time matrices to %s in %0.0f s" % (count, args.storeFolder, time.time()-start)
+
+if __name__ == '__main__':
+    main()
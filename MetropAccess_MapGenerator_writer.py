@@ -0,0 +1,164 @@
+# -*- coding: cp1252 -*-
+
+#---------------------------------------------
+# METROPACCESS-MAPGENERATOR
+# Accessibility Research Group
+# University of Helsinki
+# Authored by Henrikki Tenkanen
+# Licenced with GNU General Public License v3.
+#---------------------------------------------
+
+#Image writer for the maps: the figure is drawn to an RGBA buffer with a fixed bounding box (no extra draw pass of bbox_inches='tight')
+#and the buffer is encoded and written to disk in background threads. Files are written to a temporary file first and renamed
+#when they are complete, so a map file on disk is never half written.
+
+import os, io
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import matplotlib.image as mimage
+from matplotlib.transforms import Bbox, TransformedBbox, Affine2D
+
+#PIL is needed only for JPEG and WebP (PNG is written with matplotlib if PIL is not installed)
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+#Image formats and their file extensions
+FORMATS = {'png': '.png', 'jpeg': '.jpg', 'webp': '.webp'}
+
+def tightBbox(fig, dpi, pad=0.1):
+    """Bounding box (inches) of the figure contents at the given resolution, the same that savefig(bbox_inches='tight') uses"""
+    originalDpi = fig.dpi
+    fig.dpi = dpi
+    try:
+        fig.canvas.draw()
+        renderer = fig._cachedRenderer
+        bbox = fig.get_tightbbox(renderer)
+
+        #Legends and texts outside the axes are included like savefig does it
+        extents = []
+        for artist in fig.get_default_bbox_extra_artists():
+            extent = artist.get_window_extent(renderer)
+            if artist.get_clip_on() and artist.get_clip_box() != None:
+                extent = Bbox.intersection(extent, artist.get_clip_box())
+            if extent != None and (extent.width != 0 or extent.height != 0):
+                extents.append(extent)
+        if len(extents) > 0:
+            bbox = Bbox.union([bbox, TransformedBbox(Bbox.union(extents), Affine2D().scale(1.0/dpi))])
+    finally:
+        fig.dpi = originalDpi
+    return bbox.padded(pad)
+
+def replaceFile(tmpPath, path):
+    #Rename a completed temporary file to its final name. The rename replaces the old file atomically on POSIX,
+    #os.rename does not overwrite on Windows --> the old file is removed first there.
+    if os.name == 'nt' and os.path.isfile(path):
+        os.remove(path)
+    os.rename(tmpPath, path)
+
+class ImageWriter:
+    """Writes figures to disk as PNG, JPEG or WebP. With threads > 0 encoding and writing happen in a thread pool
+    (call flush before the files are needed)."""
+    def __init__(self, imageFormat='png', compression=6, quality=90, threads=0, maxPending=4):
+        """Constructor. compression is the zlib level of PNG (0-9), quality is used for JPEG and WebP (1-100)."""
+        if not imageFormat in FORMATS:
+            raise ValueError("Unknown image format '%s' (use one of %s)" % (imageFormat, ", ".join(sorted(FORMATS.keys()))))
+        if imageFormat != 'png' and Image == None:
+            raise ImportError("Writing %s images requires PIL (Pillow)" % imageFormat)
+
+        self.format = imageFormat
+        self.extension = FORMATS[imageFormat]
+        self.compression = compression
+        self.quality = quality
+
+        #Images waiting to be written (limited, each one holds a full size RGBA buffer)
+        self.maxPending = maxPending
+        self.pending = []
+        self.errors = []
+
+        self.pool = None
+        if threads > 0:
+            self.pool = ThreadPool(threads)
+
+    def save(self, fig, outputPath, dpi, bbox):
+        """Draws the figure inside bbox (inches) and writes it to outputPath (in the background if the writer has threads)"""
+
+        #Drawing uses matplotlib --> happens in the calling thread
+        buf = io.BytesIO()
+        fig.savefig(buf, format='rgba', dpi=dpi, bbox_inches=bbox)
+        width, height = int(bbox.width*dpi), int(bbox.height*dpi)
+        rgba = np.frombuffer(buf.getvalue(), np.uint8)
+        if len(rgba) != width*height*4:
+            raise ValueError("Image buffer of %s does not match the bounding box (%d x %d)" % (outputPath, width, height))
+        rgba = rgba.reshape(height, width, 4)
+        del buf
+
+        if self.pool == None:
+            self.write(rgba, outputPath, dpi)
+            return
+
+        #Wait for the oldest images if too many are waiting
+        while len(self.pending) >= self.maxPending:
+            self.wait(self.pending.pop(0))
+
+        self.pending.append((outputPath, self.pool.apply_async(self.write, (rgba, outputPath, dpi))))
+
+    def write(self, rgba, outputPath, dpi):
+        #Encode the image to a temporary file and rename it when it is complete
+        tmpPath = "%s.%d.tmp" % (outputPath, os.getpid())
+        try:
+            with open(tmpPath, 'wb') as f:
+                self.encode(rgba, f, dpi)
+            replaceFile(tmpPath, outputPath)
+        except:
+            if os.path.isfile(tmpPath):
+                os.remove(tmpPath)
+            raise
+
+    def encode(self, rgba, f, dpi):
+        if Image == None:
+            mimage.imsave(f, rgba, format='png', dpi=dpi)
+            return
+
+        img = Image.fromarray(rgba, 'RGBA')
+        if self.format == 'png':
+            img.save(f, 'PNG', compress_level=self.compression, dpi=(dpi, dpi))
+        elif self.format == 'jpeg':
+            #JPEG has no alpha channel (the maps have a white background)
+            img.convert('RGB').save(f, 'JPEG', quality=self.quality, dpi=(dpi, dpi))
+        else:
+            img.save(f, 'WEBP', quality=self.quality)
+
+    def wait(self, item):
+        #Wait for one background write, errors are printed and collected (they can not be returned with the map anymore)
+        outputPath, result = item
+        try:
+            result.get()
+        except Exception as e:
+            print "Writing %s failed: %s" % (os.path.basename(outputPath), e)
+            self.errors.append((outputPath, e))
+
+    def poll(self):
+        #Collect the background writes that are done already (without waiting)
+        while len(self.pending) > 0 and self.pending[0][1].ready():
+            self.wait(self.pending.pop(0))
+
+    def pendingPaths(self):
+        #Files that are still being written
+        return [outputPath for outputPath, result in self.pending]
+
+    def flush(self):
+        """Waits until all images are written. Returns the errors of the background writes since the last flush."""
+        while len(self.pending) > 0:
+            self.wait(self.pending.pop(0))
+        errors = self.errors
+        self.errors = []
+        return errors
+
+    def close(self):
+        self.flush()
+        if self.pool != None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
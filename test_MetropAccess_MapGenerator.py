@@ -0,0 +1,254 @@
+# -*- coding: cp1252 -*-
+
+#---------------------------------------------
+# METROPACCESS-MAPGENERATOR
+# Accessibility Research Group
+# University of Helsinki
+# Authored by Henrikki Tenkanen
+# Licenced with GNU General Public License v3.
+#---------------------------------------------
+
+#Tests of MapGenerator with a small synthetic grid (see MetropAccess_MapGenerator_benchmark).
+#
+#Usage: python -m unittest test_MetropAccess_MapGenerator
+
+import os, json, time, shutil, tempfile, unittest
+from fractions import Fraction
+from itertools import combinations
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.cm as cm
+import matplotlib.pyplot as plt
+
+import MetropAccess_MapGenerator_batch as MGBatch
+import MetropAccess_MapGenerator_benchmark as MGB
+import MetropAccess_MapGenerator_classes as MGC
+import MetropAccess_MapGenerator_store as MGS
+
+try:
+    from pysal.esda.mapclassify import Fisher_Jenks, Quantiles
+except ImportError:
+    Fisher_Jenks = None
+
+class MapGeneratorTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        #One MapGenerator for all tests (creating it reads the synthetic shapefiles)
+        cls.folder = tempfile.mkdtemp()
+        cls.paths = MGB.generateData(os.path.join(cls.folder, "data"), columns=20, rows=15, matrices=2)
+        cls.files = sorted(MGS.matrixFiles(cls.paths['matrices']), key=MGS.destinationId)
+        os.makedirs(os.path.join(cls.folder, "maps"))
+
+        Geometries = MGC.MapInstance(cls.paths['grid'], cls.paths['coast'], cls.paths['roads'], cls.paths['metro'], os.path.join(cls.folder, "cache"))
+        cls.MG = MGC.MapGenerator(Geometries.getBasemap(), Geometries.getYkr(), cls.paths['population'], Geometries.getCoast(), Geometries.getRoads(),
+                                  Geometries.getMetro(), os.path.join(cls.folder, "maps"), 'PT_total_time', '10 Minute Equal Intervals',
+                                  Geometries.getCoords(), 10, renderCache=False, gridIndex=Geometries.getGridIndex())
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.MG.closeStatistics()
+        cls.MG.closeWriter()
+        shutil.rmtree(cls.folder)
+
+    def testColormapIsMadeOnce(self):
+        first = self.MG.my_colormap(cm.RdYlBu, 12)
+        self.assertIs(self.MG.my_colormap(cm.RdYlBu, 12), first)
+        self.assertIsNot(self.MG.my_colormap(cm.RdYlBu, 11), first)
+
+    def testDistancePopulationCurveIsInKilometers(self):
+        fig = plt.figure()
+        try:
+            ax = fig.add_subplot(111)
+            mapData = self.MG.prepareMap(self.files[0], self.MG.readMatrix(self.files[0]), 'Car_dist', '10 Km Equal Intervals')
+            self.MG.drawPopulation(ax, mapData['cumPop'], mapData['measure2'])
+
+            #Curve has points inside the km axis (0-50 km), the synthetic grid is only a few kilometers wide
+            xmin, xmax = ax.get_xlim()
+            x = ax.collections[0].get_paths()[0].vertices[:, 0]
+            self.assertTrue(((x > xmin) & (x < xmax)).any())
+            self.assertTrue(x.max() < xmax)
+        finally:
+            plt.close(fig)
+
+    def testMemoryDoesNotGrow(self):
+        #Short version of the --long benchmark: without pruning the template leaks about 0.1 MB per map
+        memory, growth = MGB.memoryGrowth(self.paths, self.files, os.path.join(self.folder, "long"), os.path.join(self.folder, "cache"),
+                                          maps=80, warmup=10, dpi=50)
+        if growth == None:
+            self.skipTest("resident memory can not be read")
+        self.assertLess(growth, 3)
+
+class RunJournalTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.paths = MGB.generateData(os.path.join(cls.folder, "data"), columns=20, rows=15, matrices=3)
+        cls.files = sorted(MGS.matrixFiles(cls.paths['matrices']), key=MGS.destinationId)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+
+    def setUp(self):
+        self.output = tempfile.mkdtemp(dir=self.folder)
+        self.journalPath = os.path.join(self.output, "RunJournal_PT_total_time.txt")
+
+    def runMaps(self):
+        #Run with a journal, returns the number of files that were processed (not skipped)
+        Parameters = (self.paths['matrices'], self.paths['grid'], self.paths['population'], self.paths['coast'], self.paths['roads'],
+                      self.paths['metro'], self.output, 'PT_total_time', '10 Minute Equal Intervals', 10)
+        Run = MGBatch.MapRun(Parameters, self.files, {'cacheFolder': os.path.join(self.folder, "cache"), 'renderCache': False, 'dpi': 50})
+        Run.run()
+        return Run.processed - Run.skipped
+
+    def journalEntries(self):
+        with open(self.journalPath) as f:
+            return [json.loads(line) for line in f.read().split('\n') if line != ""]
+
+    def killRun(self, completed):
+        #Journal as if the run was killed after completed files, while writing the next entry
+        with open(self.journalPath) as f:
+            lines = f.readlines()
+        with open(self.journalPath, 'w') as f:
+            f.write("".join(lines[:1+completed]))
+            f.write(lines[1+completed][:20])
+
+    def statisticsIds(self):
+        with open(os.path.join(self.output, "MeanTravelTimes_PT_total_time.csv")) as f:
+            return [line.split(';')[0] for line in f.readlines()[1:]]
+
+    def testKilledRunIsResumed(self):
+        self.assertEqual(self.runMaps(), 3)
+        self.killRun(1)
+        self.assertEqual(self.runMaps(), 2)
+
+        #Cut-off line was dropped, the resumed files were added once
+        entries = self.journalEntries()
+        self.assertEqual([entry.get('file') for entry in entries[1:-1]], [os.path.basename(f)[:-4] for f in self.files])
+        self.assertTrue(entries[-1].get('finished'))
+        ids = self.statisticsIds()
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(len(set(ids)), 3)
+
+    def testFinishedRunIsDoneAgain(self):
+        self.assertEqual(self.runMaps(), 3)
+        self.assertTrue(self.journalEntries()[-1].get('finished'))
+        self.assertEqual(self.runMaps(), 3)
+        self.assertEqual(len(self.journalEntries()), 5)
+
+    def testChangedInputStartsNewJournal(self):
+        self.assertEqual(self.runMaps(), 3)
+        self.killRun(2)
+
+        #Newer population file --> completed files are not skipped
+        population = self.paths['population']
+        try:
+            os.utime(population, (time.time(), os.path.getmtime(population)+10))
+            self.assertEqual(self.runMaps(), 3)
+        finally:
+            os.utime(population, (time.time(), os.path.getmtime(population)-10))
+
+class ShardTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.paths = MGB.generateData(os.path.join(cls.folder, "data"), columns=20, rows=15, matrices=7)
+        cls.files = sorted(MGS.matrixFiles(cls.paths['matrices']), key=MGS.destinationId)
+        cls.gridIndex = MGC.loadGridIndex(cls.paths['grid'], cls.paths['coast'], cls.paths['roads'], cls.paths['metro'], os.path.join(cls.folder, "cache"))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+
+    def statistics(self, outputFolder, files, shard=None):
+        #Statistics files of the files like --statistics-only writes them
+        os.makedirs(outputFolder)
+        SG = MGC.StatisticsGenerator(self.gridIndex, outputFolder, ['PT_total_time', 'Car_dist'], blockSize=3, shard=shard)
+        rows = {'PT_total_time': [], 'Car_dist': []}
+        for basenames, blockRows in SG.blocks(files):
+            for attribute in rows:
+                rows[attribute].extend(blockRows[attribute])
+        SG.writeStatistics(rows)
+
+    def readStatistics(self, outputFolder, attribute):
+        with open(MGC.statisticsPath(outputFolder, attribute)) as f:
+            return f.read()
+
+    def testMergedShardsAreTheSameAsOneRun(self):
+        whole = os.path.join(self.folder, "whole")
+        self.statistics(whole, self.files)
+
+        for method in ['hash', 'range']:
+            sharded = os.path.join(self.folder, method)
+            shards = [MGC.shardFiles(self.files, (i, 3), method) for i in [1, 2, 3]]
+            self.assertEqual(sorted(sum(shards, [])), sorted(self.files))
+            for i, files in enumerate(shards):
+                self.statistics(os.path.join(sharded, str(i+1)), files, (i+1, 3))
+
+            #Fragments of the machines are collected to one folder for merging
+            for i in [1, 2, 3]:
+                for name in os.listdir(os.path.join(sharded, str(i))):
+                    shutil.copy(os.path.join(sharded, str(i), name), sharded)
+
+            for attribute in ['PT_total_time', 'Car_dist']:
+                self.assertEqual(MGC.mergeStatistics(sharded, attribute), (len(self.files), 3))
+                self.assertEqual(self.readStatistics(sharded, attribute), self.readStatistics(whole, attribute))
+
+def squaredDeviations(values, bins):
+    #Sum of squared deviations from the class means (classes are the values up to each bin)
+    values = np.asarray(values, dtype=float)
+    classes = np.searchsorted(bins, values)
+    return sum(((values[classes == c] - values[classes == c].mean())**2).sum() for c in np.unique(classes))
+
+def bruteForceJenks(distinct, counts, k):
+    """Fisher-Jenks breaks of a histogram by trying all splits to k classes (exact sums with fractions). Of equally good splits
+    the one with the smallest start of the last class is chosen, then of the class before it and so on."""
+    def deviations(i, j):
+        w = sum(counts[i:j])
+        s = sum(Fraction(int(x)) * c for x, c in zip(distinct[i:j], counts[i:j]))
+        return sum(Fraction(int(x))**2 * c for x, c in zip(distinct[i:j], counts[i:j])) - s*s/w
+    def cost(starts):
+        ends = list(starts) + [len(distinct)]
+        return sum(deviations(i, j) for i, j in zip([0] + list(starts), ends))
+    starts = min(combinations(range(1, len(distinct)), k-1), key=lambda starts: (cost(starts), starts[::-1]))
+    return [distinct[i-1] for i in starts] + [distinct[-1]]
+
+class BreaksTest(unittest.TestCase):
+
+    def testFisherJenksIsOptimal(self):
+        random = np.random.RandomState(0)
+        for test in xrange(200):
+            distinct = np.unique(random.randint(0, 20, random.randint(2, 9)))
+            counts = random.randint(1, 4, len(distinct))
+            for k in xrange(2, min(len(distinct), 4)+1):
+                self.assertEqual(list(MGC.histogramFisherJenks(distinct, counts, k)), bruteForceJenks(distinct, counts, k))
+
+    def testFisherJenksTies(self):
+        #Equally good splits --> the last class starts as early as possible
+        self.assertEqual(list(MGC.histogramFisherJenks(np.array([0, 1, 2]), np.array([1, 1, 1]), 2)), [0, 2])
+        self.assertEqual(list(MGC.histogramFisherJenks(np.array([0, 1, 2, 3, 4]), np.array([1, 1, 1, 1, 1]), 2)), [1, 4])
+        self.assertEqual(list(MGC.histogramFisherJenks(np.array([0, 1, 2, 3, 4]), np.array([1, 1, 1, 1, 1]), 4)), [0, 1, 2, 4])
+        self.assertEqual(list(MGC.histogramFisherJenks(np.array([0, 1, 2]), np.array([1, 1, 1]), 3)), [0, 1, 2])
+
+    @unittest.skipIf(Fisher_Jenks == None, "pysal is not installed")
+    def testSameBreaksAsPysal(self):
+        random = np.random.RandomState(1)
+        for test in xrange(20):
+            values = random.randint(0, random.randint(10, 60), random.randint(20, 80))
+            for k in [3, 5, 7]:
+                quantiles = MGC.dataDrivenBreaks(values, 'Quantiles', k)
+                self.assertTrue(np.allclose(quantiles.bins, Quantiles(values, k=k).bins))
+                self.assertEqual(list(quantiles.counts), list(Quantiles(values, k=k).counts))
+
+                #pysal resolves ties between equally good classifications in single precision --> the breaks may differ then
+                fast = MGC.dataDrivenBreaks(values, "Fisher's Jenks", k)
+                pysal = Fisher_Jenks(values, k=k)
+                if len(fast.bins) != len(pysal.bins) or not np.allclose(fast.bins, pysal.bins):
+                    self.assertAlmostEqual(squaredDeviations(values, fast.bins), squaredDeviations(values, pysal.bins))
+
+if __name__ == '__main__':
+    unittest.main()